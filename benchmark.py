@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+# ===================================================
+#              iOS Hooker Benchmarks
+# ===================================================
+#
+#  About: Generates a synthetic class-dump-z style
+#  header corpus and times each stage of ios-hooker
+#  (discovery, parsing and emission) separately.
+#  Results are written as JSON so that runs can be
+#  compared across commits.
+#
+
+import gc
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python < 3.4
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+HOOKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ios-hooker.py')
+CORPUS_PARAMS = 'corpus.json'
+KNOWN_RETURNS = ['id', 'void', 'BOOL', 'int', 'float', 'unsigned int', 'NSString*',
+    'NSArray*', 'NSData*', 'NSDictionary*', 'NSNumber*']
+KNOWN_ARGUMENTS = ['id', 'BOOL', 'int', 'float', 'NSString*', 'NSData*', 'NSError**']
+UNKNOWN_TYPES = ['CGRect', 'struct _NSZone*', 'UIView*', 'SEL', 'Class', 'void (^)(BOOL)']
+
+
+def load_hooker():
+    ''' ios-hooker.py isn't a valid module name, so load it by path '''
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('ios_hooker', HOOKER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('ios_hooker', HOOKER_PATH)
+
+def peak_memory():
+    ''' Peak resident set size of this process in bytes '''
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if platform.system().lower() == 'darwin' else usage * 1024
+
+def git_revision():
+    ''' Current commit, so results can be matched to the code they measured '''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(HOOKER_PATH),
+            stderr=subprocess.STDOUT,
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+### Corpus
+def pick_type(rng, known, unknown_ratio):
+    if rng.random() < unknown_ratio:
+        return rng.choice(UNKNOWN_TYPES)
+    return rng.choice(known)
+
+def generate_header(rng, index, args):
+    ''' Source of a single synthetic class-dump-z header '''
+    class_name = "BenchClass%d" % index
+    superclass = "NSObject" if index % 10 == 0 else "BenchClass%d" % (index - index % 10)
+    lines = [
+        '/**',
+        ' * This header is generated by class-dump-z 0.2a.',
+        ' */',
+        '',
+        '#import "%s.h"' % superclass,
+        '',
+        '@interface %s : %s <NSCoding, NSCopying> {' % (class_name, superclass),
+        '\tNSString* _name;',
+        '}',
+    ]
+    for number in range(args.properties):
+        lines.append('@property(retain, nonatomic) %s property%d;' % (
+            pick_type(rng, KNOWN_RETURNS[2:], args.unknown_ratio), number,
+        ))
+    for number in range(args.methods):
+        sign = '+' if rng.random() < 0.2 else '-'
+        ret = pick_type(rng, KNOWN_RETURNS, args.unknown_ratio)
+        arg_count = rng.randint(0, 4)
+        if arg_count == 0:
+            lines.append('%s(%s)method%d;' % (sign, ret, number))
+            continue
+        parts = []
+        for arg in range(arg_count):
+            label = "method%d" % number if arg == 0 else "with%d" % arg
+            parts.append('%s:(%s)arg%d' % (
+                label, pick_type(rng, KNOWN_ARGUMENTS, args.unknown_ratio), arg,
+            ))
+        separator = '\n\t\t' if rng.random() < args.multiline_ratio else ' '
+        lines.append('%s(%s)%s;' % (sign, ret, separator.join(parts)))
+    lines.append('@end')
+    return class_name, '\n'.join(lines) + '\n'
+
+def corpus_params(args):
+    ''' Everything the generated corpus depends on '''
+    return {
+        'classes': args.classes, 'methods': args.methods,
+        'properties': args.properties, 'directories': args.directories,
+        'multiline_ratio': args.multiline_ratio,
+        'unknown_ratio': args.unknown_ratio, 'seed': args.seed,
+    }
+
+def read_corpus_params(corpus_dir):
+    ''' Parameters a --corpus directory was generated with, None if it has none '''
+    try:
+        with open(os.path.join(corpus_dir, CORPUS_PARAMS)) as params_fp:
+            return json.load(params_fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+def generate_corpus(corpus_dir, args):
+    ''' Write the synthetic headers, nested like a dump with frameworks '''
+    with open(os.path.join(corpus_dir, CORPUS_PARAMS), 'w') as params_fp:
+        json.dump(corpus_params(args), params_fp, indent=2, sort_keys=True)
+    rng = random.Random(args.seed)
+    for index in range(args.classes):
+        class_name, source = generate_header(rng, index, args)
+        directory = os.path.join(corpus_dir, "Framework%d" % (index % args.directories))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, class_name + '.h'), 'w') as header_fp:
+            header_fp.write(source)
+
+
+### Stages
+def hooker_options(args):
+    ''' The same namespace __main__ in ios-hooker.py would build '''
+    return argparse.Namespace(
+        verbose=False, next_step=False, file_regex=None, include=[], exclude=[],
+        unknowns=True, getters=args.getters, setters=args.setters,
+        params=args.params, debug=False, method_filter=None,
+    )
+
+def model_memory(header_files, options):
+    '''
+    Bytes still allocated for the parsed models of every header once the
+    sources are dropped; a fresh copy of ios-hooker is loaded so nothing is
+    shared with the timed stages
+    '''
+    if tracemalloc is None:
+        return None
+    hooker = load_hooker()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        models = []
+        methods = 0
+        for header_file in header_files:
+            interfaces = hooker.ObjcHeader(header_file, options.unknowns, options.verbose).interfaces
+            methods += sum(
+                len(interface.class_methods) + len(interface.instance_methods) +
+                len(interface.properties) for interface in interfaces
+            )
+            models.append(interfaces)
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {'bytes': retained, 'methods': methods,
+        'bytes_per_method': retained / float(methods) if methods else 0}
+
+def timed(function, *arguments):
+    start = time.time()
+    value = function(*arguments)
+    return value, time.time() - start
+
+def run_benchmark(hooker, corpus_dir, args):
+    ''' Time each stage of a full run over the corpus '''
+    options = hooker_options(args)
+    results = {}
+
+    header_files, elapsed = timed(lambda: list(hooker.scan_directory(corpus_dir, options)))
+    results['discovery'] = {'seconds': elapsed, 'files': len(header_files)}
+
+    (options.type_index, total), elapsed = timed(hooker.build_type_index, header_files)
+    results['type_index'] = {'seconds': elapsed, 'types': len(options.type_index)}
+
+    def parse():
+        headers = []
+        for header_file in header_files:
+            objc = hooker.ObjcHeader(header_file, options.unknowns, options.verbose)
+            objc.types = options.type_index
+            objc.interfaces
+            headers.append(objc)
+        return headers
+    headers, elapsed = timed(parse)
+    methods = sum(
+        len(objc.interface.class_methods) + len(objc.interface.instance_methods) +
+        len(objc.interface.properties) for objc in headers
+    )
+    results['parsing'] = {'seconds': elapsed, 'methods': methods}
+
+    def emit():
+        output = StringIO()
+        hooks = 0
+        for objc in headers:
+            objc.getters = options.getters
+            objc.setters = options.setters
+            objc.params = options.params
+            objc.save_hooks(output, options.method_filter)
+            hooks += objc._hook_count
+        return hooks, len(output.getvalue())
+    (hooks, length), elapsed = timed(emit)
+    results['emission'] = {'seconds': elapsed, 'hooks': hooks, 'bytes': length}
+
+    total_seconds = sum(stage['seconds'] for stage in results.values())
+    results['total'] = {
+        'seconds': total_seconds,
+        'files_per_second': len(header_files) / total_seconds if total_seconds else 0,
+        'hooks_per_second': hooks / total_seconds if total_seconds else 0,
+        'peak_memory': peak_memory(),
+    }
+    headers = None  # Let the timed models go before measuring a fresh parse
+    results['model_memory'] = model_memory(header_files, options)
+    return results
+
+def print_results(results):
+    for stage in ['discovery', 'type_index', 'parsing', 'emission']:
+        details = ', '.join(
+            "%s=%s" % (key, value) for key, value in sorted(results[stage].items())
+            if key != 'seconds'
+        )
+        print("%-12s %8.3fs  %s" % (stage, results[stage]['seconds'], details))
+    total = results['total']
+    print("%-12s %8.3fs  %.0f files/sec, %.0f hooks/sec, peak memory %.1f MB" % (
+        'total', total['seconds'], total['files_per_second'],
+        total['hooks_per_second'], total['peak_memory'] / (1024.0 * 1024.0),
+    ))
+    model = results['model_memory']
+    if model is not None:
+        print("%-12s %8.1f MB retained by %d parsed method(s), %.0f bytes/method" % (
+            'models', model['bytes'] / (1024.0 * 1024.0), model['methods'],
+            model['bytes_per_method'],
+        ))
+
+
+### Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark ios-hooker over a synthetic class-dump corpus',
+    )
+    parser.add_argument('--classes', '-c',
+        help='number of header files to generate (default: 2000)',
+        type=int,
+        default=2000,
+    )
+    parser.add_argument('--methods', '-m',
+        help='methods per class (default: 30)',
+        type=int,
+        default=30,
+    )
+    parser.add_argument('--properties', '-p',
+        help='properties per class (default: 8)',
+        type=int,
+        default=8,
+    )
+    parser.add_argument('--directories', '-d',
+        help='number of framework directories to spread headers over (default: 20)',
+        type=int,
+        default=20,
+    )
+    parser.add_argument('--multiline-ratio',
+        help='fraction of methods with arguments split over several lines (default: 0.2)',
+        dest='multiline_ratio',
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument('--unknown-ratio',
+        help='fraction of types that are unknown (default: 0.1)',
+        dest='unknown_ratio',
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument('--seed',
+        help='random seed for the generated corpus (default: 1)',
+        type=int,
+        default=1,
+    )
+    parser.add_argument('--corpus',
+        help='keep the generated corpus in this directory, reused while its parameters match',
+        default=None,
+    )
+    parser.add_argument('--getters', '-g',
+        help='create hooks for @property getters (default: false)',
+        action='store_true',
+    )
+    parser.add_argument('--setters', '-s',
+        help='create hooks for @property setters (default: false)',
+        action='store_true',
+    )
+    parser.add_argument('--params',
+        help='log function parameter values (default: false)',
+        action='store_true',
+    )
+    parser.add_argument('--output', '-o',
+        help='write JSON results to this file (default: benchmark.json)',
+        default='benchmark.json',
+    )
+    args = parser.parse_args()
+    hooker = load_hooker()
+    corpus_dir = args.corpus if args.corpus is not None else tempfile.mkdtemp(prefix='ios-hooker-')
+    try:
+        if os.path.isdir(corpus_dir) and os.listdir(corpus_dir):
+            params = read_corpus_params(corpus_dir)
+            if params is None:
+                print(hooker.WARN + "%s is not a corpus generated by benchmark.py" % corpus_dir)
+                sys.exit(1)
+            if params != corpus_params(args):
+                print(hooker.INFO + "Corpus parameters changed, removing %s" % corpus_dir)
+                shutil.rmtree(corpus_dir)
+        if not os.path.isdir(corpus_dir):
+            os.makedirs(corpus_dir)
+        if not os.listdir(corpus_dir):
+            print(hooker.INFO + "Generating %d header(s) in %s" % (args.classes, corpus_dir))
+            generate_corpus(corpus_dir, args)
+        results = run_benchmark(hooker, corpus_dir, args)
+    finally:
+        if args.corpus is None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+    print_results(results)
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': corpus_params(args),
+        'options': {'getters': args.getters, 'setters': args.setters, 'params': args.params},
+        'results': results,
+    }
+    with open(args.output, 'w') as output_fp:
+        json.dump(report, output_fp, indent=2, sort_keys=True)
+    print(hooker.INFO + "Results written to: %s" % args.output)
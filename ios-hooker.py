@@ -12,8 +12,48 @@
 import os
 import re
 import sys
+import mmap
+import json
+import stat
+import time
+import heapq
+import signal
+import socket
+import shutil
 import platform
+import pickle
+import sqlite3
+import struct
+import fnmatch
+import hashlib
 import argparse
+import collections
+import multiprocessing
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None  # Python < 3.5
+
+try:
+    from sys import intern
+except ImportError:
+    pass  # Python 2 has intern() as a builtin
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Traces are decoded one record at a time
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None  # Python 2, the serve subcommand is not available
 
 
 if platform.system().lower() in ['linux', 'darwin']:
@@ -24,7 +64,7 @@ else:
     WARN = "[!] "
 
 # Makes for easy compiling; this can of course be optionally disabled
-KNOWN_TYPES = [
+KNOWN_TYPES = frozenset([
     'id', 'NSObject', 'void', 'char', 'int', 'unsigned', 'double', 'float', 'long', 'bool', 'BOOL',
     'NSAffineTransform','NSAppleEventDescriptor','NSAppleEventManager','NSAppleScript',
     'NSArchiver','NSArray','NSAssertionHandler','NSAttributedString','NSAutoreleasePool',
@@ -69,26 +109,525 @@ KNOWN_TYPES = [
     'NSURLAuthenticationChallengeSender','NSURLConnectionDataDelegate','NSURLConnectionDelegate',
     'NSURLConnectionDelegate','NSURLHandleClient','NSURLProtocolClient','NSUserNotificationCenterDelegate',
     'NSXMLParserDelegate','NSXPCListenerDelegate','NSXPCProxyCreating',
-]
+])
 NSLOG = {"int": "d", "unsigned": "d", "BOOL": "d", "float": "g"}
+PRINTF_KINDS = {"@": "o", "d": "i", "g": "f"}
+DECLARATIONS = ('+', '-', '@property', '@interface', '@protocol', '@end')
+INTERFACE_DECL = re.compile(
+    r'@interface\s+(\w+)\s*(?:\(\s*(\w*)\s*\))?\s*(?::\s*(\w+))?\s*(?:<([^>]*)>)?'
+)
+PROPERTY_DECL = re.compile(r'@property\s*(?:\([^)]*\))?\s*(.*?)\s*(\w+)\s*;?$')
+SELECTOR_PART = re.compile(r'(\w*)\s*:\s*')
+LOG_CALL = re.compile(
+    br'[+-]\[<?(\w+)(?:: 0x[0-9a-fA-F]+>)? (\w+)'
+    br'|\[(?:<- Getter|Setter ->)\]\([^)\n]*\) (\w+):'
+)
+LITERAL_SELECTOR = re.compile(r'^[A-Za-z_]\w*$')
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P[<=]')
+TYPE_DEFINITION = re.compile(r'^[ \t]*@(interface|protocol)[ \t]+(\w+)([^\n]*)', re.M)
+SECTION_BOUNDARY = re.compile(br'^[ \t]*@(interface|end)\b[ \t]*(\w*)(?:[ \t]*\([ \t]*(\w*))?', re.M)
+CACHE_VERSION = 10
+RING_LOG_RUNTIME = '''#ifndef IOS_HOOKER_RING_LOG
+#define IOS_HOOKER_RING_LOG
+#import <os/log.h>
+#import <string.h>
+#import <pthread.h>
+#import <stdatomic.h>
+#import <dispatch/dispatch.h>
+
+/*
+ * Preallocated lock-free ring buffer; hooks only store a pointer to a
+ * static message and one scalar, a background queue formats and logs.
+ */
+#define IH_RING_SIZE 65536
+#define IH_RING_MASK (IH_RING_SIZE - 1)
+
+typedef struct {
+    _Atomic uint64_t sequence;
+    const char *message;
+    uint64_t value;
+    uint64_t thread;
+    char kind;
+} ih_ring_event_t;
+
+static ih_ring_event_t ih_ring[IH_RING_SIZE];
+static _Atomic uint64_t ih_ring_head;
+static uint64_t ih_ring_tail;
+static uint64_t ih_ring_dropped;
+static dispatch_source_t ih_ring_timer;
+
+static void ih_ring_drain(void *context) {
+    for (;;) {
+        ih_ring_event_t *slot = &ih_ring[ih_ring_tail & IH_RING_MASK];
+        uint64_t sequence = atomic_load_explicit(&slot->sequence, memory_order_acquire);
+        if (sequence <= ih_ring_tail) {
+            break;  /* Not written yet */
+        }
+        ih_ring_event_t event = {0, slot->message, slot->value, slot->thread, slot->kind};
+        atomic_thread_fence(memory_order_acquire);
+        if (sequence != ih_ring_tail + 1 ||
+                atomic_load_explicit(&slot->sequence, memory_order_relaxed) != sequence) {
+            /* Producers lapped the drain, skip to the oldest event left */
+            uint64_t head = atomic_load_explicit(&ih_ring_head, memory_order_relaxed);
+            uint64_t oldest = head > IH_RING_SIZE ? head - IH_RING_SIZE : 0;
+            if (oldest <= ih_ring_tail) {
+                oldest = ih_ring_tail + 1;
+            }
+            ih_ring_dropped += oldest - ih_ring_tail;
+            ih_ring_tail = oldest;
+            continue;
+        }
+        ih_ring_tail++;
+        switch (event.kind) {
+            case '@':
+                os_log(OS_LOG_DEFAULT, "[%llu] %{public}s%p", event.thread, event.message, (void *) event.value);
+                break;
+            case 'd':
+                os_log(OS_LOG_DEFAULT, "[%llu] %{public}s%lld", event.thread, event.message, (long long) event.value);
+                break;
+            case 'u':
+                os_log(OS_LOG_DEFAULT, "[%llu] %{public}s%llu", event.thread, event.message, event.value);
+                break;
+            case 'g': {
+                double number;
+                memcpy(&number, &event.value, sizeof(number));
+                os_log(OS_LOG_DEFAULT, "[%llu] %{public}s%g", event.thread, event.message, number);
+                break;
+            }
+            default:
+                os_log(OS_LOG_DEFAULT, "[%llu] %{public}s", event.thread, event.message);
+        }
+    }
+}
+
+static void ih_ring_start(void) {
+    dispatch_queue_t queue = dispatch_queue_create("ios-hooker.log", DISPATCH_QUEUE_SERIAL);
+    ih_ring_timer = dispatch_source_create(DISPATCH_SOURCE_TYPE_TIMER, 0, 0, queue);
+    dispatch_source_set_timer(ih_ring_timer, DISPATCH_TIME_NOW, 100 * NSEC_PER_MSEC, 10 * NSEC_PER_MSEC);
+    dispatch_source_set_event_handler_f(ih_ring_timer, ih_ring_drain);
+    dispatch_resume(ih_ring_timer);
+}
+
+static inline void ih_ring_push(const char *message, char kind, uint64_t value) {
+    static dispatch_once_t once;
+    dispatch_once_f(&once, NULL, (dispatch_function_t) ih_ring_start);
+    uint64_t index = atomic_fetch_add_explicit(&ih_ring_head, 1, memory_order_relaxed);
+    ih_ring_event_t *slot = &ih_ring[index & IH_RING_MASK];
+    atomic_store_explicit(&slot->sequence, 0, memory_order_relaxed);
+    atomic_thread_fence(memory_order_release);
+    slot->message = message;
+    slot->kind = kind;
+    slot->value = value;
+    pthread_threadid_np(NULL, &slot->thread);
+    atomic_store_explicit(&slot->sequence, index + 1, memory_order_release);
+}
+
+static inline uint64_t ih_double_bits(double number) {
+    uint64_t bits;
+    memcpy(&bits, &number, sizeof(bits));
+    return bits;
+}
+
+#define IH_LOG(message) ih_ring_push(message, 0, 0)
+#define IH_LOG_OBJECT(message, object) ih_ring_push(message, '@', (uint64_t)(uintptr_t)(__bridge void *)(object))
+#define IH_LOG_POINTER(message, pointer) ih_ring_push(message, '@', (uint64_t)(uintptr_t)(pointer))
+#define IH_LOG_INT(message, number) ih_ring_push(message, 'd', (uint64_t)(int64_t)(number))
+#define IH_LOG_UINT(message, number) ih_ring_push(message, 'u', (uint64_t)(number))
+#define IH_LOG_DOUBLE(message, number) ih_ring_push(message, 'g', ih_double_bits(number))
+#endif
+
+
+'''
+THROTTLE_RUNTIME = '''#ifndef IOS_HOOKER_THROTTLE
+#define IOS_HOOKER_THROTTLE
+#import <time.h>
+#import <stdatomic.h>
+
+/* Per-hook counters that decide if a call gets logged */
+typedef struct {
+    _Atomic uint64_t calls;
+    _Atomic uint64_t window;
+    _Atomic uint64_t logged;
+} ih_throttle_t;
+
+static inline int ih_throttle(ih_throttle_t *state, uint64_t every, uint64_t first, uint64_t rate) {
+    uint64_t call = atomic_fetch_add_explicit(&state->calls, 1, memory_order_relaxed);
+    if (first && first <= call) {
+        return 0;
+    }
+    if (1 < every && call % every) {
+        return 0;
+    }
+    if (rate) {
+        uint64_t now = (uint64_t) time(NULL);
+        uint64_t window = atomic_load_explicit(&state->window, memory_order_relaxed);
+        if (window != now && atomic_compare_exchange_strong(&state->window, &window, now)) {
+            atomic_store_explicit(&state->logged, 0, memory_order_relaxed);
+        }
+        if (rate <= atomic_fetch_add_explicit(&state->logged, 1, memory_order_relaxed)) {
+            return 0;
+        }
+    }
+    return 1;
+}
+#endif
+
+
+'''
+GROUP_RUNTIME = '''#ifndef IOS_HOOKER_GROUPS
+#define IOS_HOOKER_GROUPS
+#import <dlfcn.h>
+#import <stdlib.h>
+#import <string.h>
+#import <objc/runtime.h>
+#import <mach-o/dyld.h>
+
+/*
+ * Every hooked class is a %group of its own; a group is only initialized
+ * once the image that defines its class is loaded, and never if its unit
+ * is turned off in the preferences plist.  classes[] is sorted so each
+ * loaded class is a binary search, dyld runs the callbacks one at a time.
+ * The helpers are unused in a file without --group-prefs or without groups.
+ */
+typedef struct {
+    const char *const *classes;
+    const char *const *units;
+    unsigned char *done;
+    unsigned int count;
+    void (*init)(unsigned int group);
+} ih_groups_t;
+
+__attribute__((unused)) static void ih_groups_prefs(ih_groups_t *groups, const char *path) {
+    NSDictionary *prefs = [NSDictionary dictionaryWithContentsOfFile:[NSString stringWithUTF8String:path]];
+    for (unsigned int group = 0; group < groups->count; ++group) {
+        NSString *unit = [NSString stringWithUTF8String:groups->units[group]];
+        if (![[prefs objectForKey:unit] boolValue]) {
+            groups->done[group] = 1;
+        }
+    }
+}
+
+__attribute__((unused)) static void ih_groups_image(ih_groups_t *groups, const struct mach_header *header) {
+    Dl_info info;
+    if (!dladdr(header, &info) || info.dli_fname == NULL) {
+        return;
+    }
+    unsigned int count = 0;
+    const char **names = objc_copyClassNamesForImage(info.dli_fname, &count);
+    for (unsigned int index = 0; index < count; ++index) {
+        unsigned int low = 0, high = groups->count;
+        while (low < high) {
+            unsigned int middle = low + (high - low) / 2;
+            if (strcmp(groups->classes[middle], names[index]) < 0) {
+                low = middle + 1;
+            } else {
+                high = middle;
+            }
+        }
+        for (; low < groups->count && !strcmp(groups->classes[low], names[index]); ++low) {
+            if (!groups->done[low]) {
+                groups->done[low] = 1;
+                groups->init(low);
+            }
+        }
+    }
+    free(names);
+}
+#endif
+
+
+'''
+TIMING_RUNTIME = '''#ifndef IOS_HOOKER_TIMING
+#define IOS_HOOKER_TIMING
+#import <stdio.h>
+#import <string.h>
+#import <unistd.h>
+#import <os/log.h>
+#import <stdatomic.h>
+#import <mach/mach_time.h>
+#import <dispatch/dispatch.h>
+
+/*
+ * Log-scale histograms of how long %orig takes, bucket b counts calls of
+ * 2^(b-1) to 2^b nanoseconds.  Each hook has a static histogram that joins
+ * a lock-free list on its first call, the list is weak so every tweak file
+ * shares it.  A constructor dumps the list to a text file every few seconds,
+ * merge the dumps with "ios-hooker.py timing".  Only the file with that
+ * constructor calls the dump functions, the other shards leave them unused.
+ */
+#define IH_TIMING_BUCKETS 48
+
+typedef struct ih_timing {
+    uint64_t selector;
+    struct ih_timing *next;
+    _Atomic int registered;
+    _Atomic uint64_t calls;
+    _Atomic uint64_t total;
+    _Atomic uint64_t buckets[IH_TIMING_BUCKETS];
+} ih_timing_t;
+
+__attribute__((weak)) _Atomic(ih_timing_t *) ih_timing_list = NULL;
+
+static inline void ih_timing_add(ih_timing_t *timing, uint64_t ticks) {
+    static mach_timebase_info_data_t timebase;
+    if (timebase.denom == 0) {
+        mach_timebase_info(&timebase);
+    }
+    uint64_t nanoseconds = ticks * timebase.numer / timebase.denom;
+    unsigned int bucket = nanoseconds ? 64 - __builtin_clzll(nanoseconds) : 0;
+    if (IH_TIMING_BUCKETS <= bucket) {
+        bucket = IH_TIMING_BUCKETS - 1;
+    }
+    atomic_fetch_add_explicit(&timing->buckets[bucket], 1, memory_order_relaxed);
+    atomic_fetch_add_explicit(&timing->total, nanoseconds, memory_order_relaxed);
+    atomic_fetch_add_explicit(&timing->calls, 1, memory_order_relaxed);
+    if (!atomic_load_explicit(&timing->registered, memory_order_relaxed)) {
+        int expected = 0;
+        if (atomic_compare_exchange_strong(&timing->registered, &expected, 1)) {
+            ih_timing_t *head = atomic_load_explicit(&ih_timing_list, memory_order_relaxed);
+            do {
+                timing->next = head;
+            } while (!atomic_compare_exchange_weak_explicit(&ih_timing_list, &head, timing,
+                memory_order_release, memory_order_relaxed));
+        }
+    }
+}
+
+__attribute__((unused)) static void ih_timing_path(char *path, size_t size) {
+    size_t length = confstr(_CS_DARWIN_USER_TEMP_DIR, path, size);
+    if (length == 0 || size < length) {
+        strcpy(path, "/tmp/");
+    }
+    length = strlen(path);
+    snprintf(path + length, size - length, "ios-hooker-%d.timing", getpid());
+}
+
+__attribute__((unused)) static void ih_timing_dump(void *context) {
+    char path[1024];
+    char temp[1040];
+    ih_timing_path(path, sizeof(path));
+    snprintf(temp, sizeof(temp), "%s.tmp", path);
+    FILE *dump = fopen(temp, "w");
+    if (dump == NULL) {
+        return;
+    }
+    fprintf(dump, "# ios-hooker timing: selector, calls, total ns, log2 ns buckets\\n");
+    ih_timing_t *timing = atomic_load_explicit(&ih_timing_list, memory_order_acquire);
+    for (; timing != NULL; timing = timing->next) {
+        fprintf(dump, "%016llx\\t%llu\\t%llu\\t", (unsigned long long) timing->selector,
+            (unsigned long long) atomic_load_explicit(&timing->calls, memory_order_relaxed),
+            (unsigned long long) atomic_load_explicit(&timing->total, memory_order_relaxed));
+        int last = IH_TIMING_BUCKETS - 1;
+        while (0 < last && !atomic_load_explicit(&timing->buckets[last], memory_order_relaxed)) {
+            --last;
+        }
+        for (int bucket = 0; bucket <= last; ++bucket) {
+            fprintf(dump, bucket ? ",%llu" : "%llu",
+                (unsigned long long) atomic_load_explicit(&timing->buckets[bucket], memory_order_relaxed));
+        }
+        fputc('\\n', dump);
+    }
+    fclose(dump);
+    rename(temp, path);
+}
+
+__attribute__((unused)) static void ih_timing_start(unsigned int seconds) {
+    static dispatch_source_t timer;
+    char path[1024];
+    ih_timing_path(path, sizeof(path));
+    timer = dispatch_source_create(DISPATCH_SOURCE_TYPE_TIMER, 0, 0,
+        dispatch_get_global_queue(QOS_CLASS_UTILITY, 0));
+    dispatch_source_set_timer(timer, dispatch_time(DISPATCH_TIME_NOW, seconds * NSEC_PER_SEC),
+        seconds * NSEC_PER_SEC, NSEC_PER_SEC / 10);
+    dispatch_source_set_event_handler_f(timer, ih_timing_dump);
+    dispatch_resume(timer);
+    os_log(OS_LOG_DEFAULT, "iOS Hooker timing: %{public}s", path);
+}
+
+#define IH_TIMING_START() uint64_t ih_started = mach_absolute_time()
+#define IH_TIMING_STOP(selector) do { \\
+    static ih_timing_t ih_timing = {selector}; \\
+    ih_timing_add(&ih_timing, mach_absolute_time() - ih_started); \\
+} while (0)
+#endif
+
+
+'''
+TRACE_MAGIC = b'IHTRACE1'
+TRACE_HEADER = struct.Struct('<8sIIQQII24x')
+TRACE_RECORD = struct.Struct('<QQQ5Q')
+TRACE_ARGS = 5
+TRACE_DTYPE = None if numpy is None else numpy.dtype([
+    ('timestamp', '<u8'), ('thread', '<u8'), ('selector', '<u8'), ('args', '<u8', (TRACE_ARGS,)),
+])
+TRACE_SCALARS = {
+    'char': 'i', 'short': 'i', 'int': 'i', 'long': 'i', 'long long': 'i', 'bool': 'i',
+    'BOOL': 'i', 'NSInteger': 'i', 'unsigned': 'u', 'unsigned char': 'u',
+    'unsigned short': 'u', 'unsigned int': 'u', 'unsigned long': 'u',
+    'unsigned long long': 'u', 'NSUInteger': 'u', 'size_t': 'u', 'float': 'f',
+    'double': 'f', 'CGFloat': 'f', 'NSTimeInterval': 'f', 'id': 'o', 'Class': 'o',
+    'SEL': 'p',
+}
+TRACE_RUNTIME = '''#ifndef IOS_HOOKER_TRACE
+#define IOS_HOOKER_TRACE
+#import <fcntl.h>
+#import <stdio.h>
+#import <string.h>
+#import <unistd.h>
+#import <os/log.h>
+#import <pthread.h>
+#import <stdatomic.h>
+#import <sys/mman.h>
+#import <mach/mach_time.h>
+#import <dispatch/dispatch.h>
+
+/*
+ * Fixed-size binary records in a memory-mapped file; hooks only copy a
+ * selector id and scalars, decode with "ios-hooker.py trace"
+ */
+#define IH_TRACE_CAPACITY (1 << 22)
+
+typedef struct {
+    char magic[8];
+    uint32_t version;
+    uint32_t record_size;
+    uint64_t capacity;
+    _Atomic uint64_t head;
+    uint32_t numer;
+    uint32_t denom;
+    uint64_t reserved[3];
+} ih_trace_header_t;
+
+typedef struct {
+    uint64_t timestamp;
+    uint64_t thread;
+    _Atomic uint64_t selector;
+    uint64_t args[5];
+} ih_trace_record_t;
+
+/* Weak, so every shard of the tweak shares one mapping and one open */
+__attribute__((weak)) ih_trace_header_t *ih_trace = NULL;
+__attribute__((weak)) dispatch_once_t ih_trace_once = 0;
+
+static void ih_trace_start(void *context) {
+    char path[1024];
+    size_t length = confstr(_CS_DARWIN_USER_TEMP_DIR, path, sizeof(path));
+    if (length == 0 || sizeof(path) < length) {
+        strcpy(path, "/tmp/");
+    }
+    length = strlen(path);
+    snprintf(path + length, sizeof(path) - length, "ios-hooker-%d.trace", getpid());
+    int fd = open(path, O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0) {
+        return;
+    }
+    size_t size = sizeof(ih_trace_header_t) + IH_TRACE_CAPACITY * sizeof(ih_trace_record_t);
+    void *map = ftruncate(fd, size) == 0 ?
+        mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0) : MAP_FAILED;
+    close(fd);
+    if (map == MAP_FAILED) {
+        return;
+    }
+    ih_trace_header_t *header = (ih_trace_header_t *) map;
+    mach_timebase_info_data_t timebase;
+    mach_timebase_info(&timebase);
+    memcpy(header->magic, "IHTRACE1", 8);
+    header->version = 1;
+    header->record_size = sizeof(ih_trace_record_t);
+    header->capacity = IH_TRACE_CAPACITY;
+    header->numer = timebase.numer;
+    header->denom = timebase.denom;
+    ih_trace = header;
+    os_log(OS_LOG_DEFAULT, "iOS Hooker trace: %{public}s", path);
+}
+
+static inline void ih_trace_push(uint64_t selector, uint64_t a0, uint64_t a1, uint64_t a2, uint64_t a3, uint64_t a4) {
+    dispatch_once_f(&ih_trace_once, NULL, ih_trace_start);
+    ih_trace_header_t *header = ih_trace;
+    if (header == NULL) {
+        return;
+    }
+    uint64_t index = atomic_fetch_add_explicit(&header->head, 1, memory_order_relaxed);
+    if (IH_TRACE_CAPACITY <= index) {
+        return;  /* Full, the decoder counts the dropped events */
+    }
+    ih_trace_record_t *record = (ih_trace_record_t *)(header + 1) + index;
+    record->timestamp = mach_absolute_time();
+    pthread_threadid_np(NULL, &record->thread);
+    record->args[0] = a0;
+    record->args[1] = a1;
+    record->args[2] = a2;
+    record->args[3] = a3;
+    record->args[4] = a4;
+    atomic_store_explicit(&record->selector, selector, memory_order_release);
+}
+
+static inline uint64_t ih_trace_double(double number) {
+    uint64_t bits;
+    memcpy(&bits, &number, sizeof(bits));
+    return bits;
+}
+
+#define IH_TRACE ih_trace_push
+#define IH_TRACE_INT(number) ((uint64_t)(int64_t)(number))
+#define IH_TRACE_UINT(number) ((uint64_t)(number))
+#define IH_TRACE_DOUBLE(number) ih_trace_double(number)
+#define IH_TRACE_OBJECT(object) ((uint64_t)(uintptr_t)(__bridge void *)(object))
+#define IH_TRACE_POINTER(pointer) ((uint64_t)(uintptr_t)(pointer))
+#endif
+
+
+'''
 
 
 class ObjcType(object):
-    ''' Represents an objective-c type '''
+    '''
+    Represents an objective-c type; identical types share one instance,
+    so they must never be modified
+    '''
 
-    def __init__(self, name, pointer=False):
-        self.class_name = name
-        self.is_pointer = pointer
-        self.comments = ""
+    __slots__ = ('class_name', 'is_pointer', 'comments')
+    _interned = {}
+
+    def __new__(cls, name, pointer=False):
+        key = (name, pointer)
+        objc_type = cls._interned.get(key)
+        if objc_type is None:
+            objc_type = object.__new__(cls)
+            objc_type.class_name = intern(name)
+            objc_type.is_pointer = pointer
+            objc_type.comments = ""
+            cls._interned[key] = objc_type
+        return objc_type
+
+    def __getnewargs__(self):
+        ''' Unpickled types are interned too '''
+        return (self.class_name, self.is_pointer)
+
+    @classmethod
+    def from_string(cls, text):
+        ''' Build a type from a declaration such as "NSString *" '''
+        text = re.sub(r'\s*\*', '*', ' '.join(text.split()))
+        if text.endswith('*'):
+            return cls(text[:-1], pointer=True)
+        return cls(text)
+
+    @property
+    def type_names(self):
+        ''' Class and protocol names this type refers to, e.g. id<Foo> -> id, Foo '''
+        class_name, _, protocols = self.class_name.rstrip('*').partition('<')
+        # This checks for things like "unsigned int"
+        names = class_name.split(' ')[-1:]
+        return names + re.findall(r'\w+', protocols)
 
     @property
     def is_known(self):
         ''' Returns boolean if the current class is in the NS-STL '''
-        # This checks for things like "unsigned int"
-        if ' ' in self.class_name:
-            return self.class_name.split(' ')[-1] in KNOWN_TYPES
-        else:
-            return self.class_name in KNOWN_TYPES
+        return self.is_known_in(KNOWN_TYPES)
+
+    def is_known_in(self, types):
+        ''' Returns boolean if every name in the type is in a set of types '''
+        return all(name in types for name in self.type_names)
 
     def __str__(self):
         return self.class_name + "*" if self.is_pointer else self.class_name
@@ -97,13 +636,12 @@ class ObjcType(object):
 class ObjcArgument(object):
     ''' Holds values for a method argument '''
 
+    __slots__ = ('external_name', 'component', 'class_type')
+
     def __init__(self, class_type, component, external_name=""):
-        self.external_name = external_name
-        self.component = component
-        if class_type.endswith('*'):
-            self.class_type = ObjcType(class_type[:-1], pointer=True)
-        else:
-            self.class_type = ObjcType(class_type)
+        self.external_name = intern(external_name)
+        self.component = intern(component)
+        self.class_type = ObjcType.from_string(class_type)
 
     def __str__(self):
         return "%s:(%s) %s" % (
@@ -114,9 +652,11 @@ class ObjcArgument(object):
 class ObjcMethod(object):
     ''' Represents an objective-c function/method '''
 
+    __slots__ = ('method_name', '_arguments', '_ret_type', 'is_static')
+
     def __init__(self, name, static=False):
-        self.method_name = name
-        self._arguments = []
+        self.method_name = intern(name)
+        self._arguments = ()
         self._ret_type = None
         self.is_static = static
 
@@ -136,34 +676,17 @@ class ObjcMethod(object):
 
     @arguments.setter
     def arguments(self, arguments):
-        '''
-        Objective-c has the dumbest argument syntax of any programming language
-        I've ever encountered so parsing it is a little wonky.  This is a dirty
-        hack that seems works okay.
-        '''
-        if 0 < len(arguments):
-            args = arguments.split(' ')
-            fixed_args = []
-            for index, arg in enumerate(args):
-                if '(' in arg and ')' in arg:
-                    fixed_args.append(arg)
-                elif '(' in arg and not ')' in arg:
-                    count = 1  # Look forward for closing ')'
-                    while ')' not in arg:
-                        arg += str(" " + args[index + count])
-                        count += 1
-                        if len(args) < (index + count):
-                            raise ValueError("Invalid syntax; no closing ')'")
-                    fixed_args.append(arg)
-            for arg in fixed_args:
-                ext_name, pair = arg.split(":")
-                class_type, component = pair.split(")")
-                method_argument = ObjcArgument(
-                    class_type[1:],
-                    component,
-                    external_name=ext_name
-                )
-                self._arguments.append(method_argument)
+        ''' Should already be ObjcArgument()s, stored as a tuple '''
+        self._arguments = tuple(arguments)
+
+    @property
+    def selector(self):
+        ''' Full selector, e.g. "setName:count:" '''
+        if not len(self.arguments):
+            return self.method_name
+        return self.method_name + ':' + ''.join(
+            [arg.external_name + ':' for arg in self.arguments[1:]]
+        )
 
     def __str__(self):
         ret = "(%s) " % str(self.return_type)
@@ -173,146 +696,487 @@ class ObjcMethod(object):
         )
 
 
+class ObjcInterface(object):
+    ''' Parsed model of a single @interface declaration '''
+
+    def __init__(self, name, superclass=None, protocols=None, category=None):
+        self.class_name = name
+        self.superclass = superclass
+        self.protocols = protocols if protocols is not None else []
+        self.category = category
+        self.class_methods = []
+        self.instance_methods = []
+        self.properties = []
+
+
+class ClassHierarchy(object):
+    '''
+    Superclass and declarations of every hooked class in the targets, so a
+    selector is only hooked in the highest class that declares it
+    '''
+
+    def __init__(self):
+        self.superclasses = {}
+        self.declared = {}
+
+    def add(self, class_name, superclass, declarations):
+        if superclass is not None:
+            self.superclasses.setdefault(class_name, superclass)
+        self.declared.setdefault(class_name, set()).update(declarations)
+
+    def ancestors(self, class_name):
+        ''' Superclasses that are in the targets, nearest first '''
+        seen = set([class_name])
+        superclass = self.superclasses.get(class_name)
+        while superclass is not None and superclass not in seen:
+            seen.add(superclass)
+            if superclass in self.declared:
+                yield superclass
+            superclass = self.superclasses.get(superclass)
+
+    def inherited(self, class_name, declarations):
+        ''' The declarations of a class that a superclass already hooks '''
+        ancestors = [self.declared[name] for name in self.ancestors(class_name)]
+        if not ancestors:
+            return frozenset()
+        return frozenset(
+            declaration for declaration in declarations
+            if any(declaration in declared for declared in ancestors)
+        )
+
+
+class HeaderDiff(object):
+    '''
+    Compares the classes of two versions of the targets.  Classes are
+    matched by name in a dict and fingerprinted with the sha1 of their
+    source, so an unchanged class is skipped with one comparison; method
+    signatures, keyed by ("+" / "-" / "@", selector), are only built for
+    classes whose source changed
+    '''
+
+    KINDS = (('+', 'class_methods'), ('-', 'instance_methods'), ('@', 'properties'))
+
+    def __init__(self):
+        self.added_classes = []
+        self.removed_classes = []
+        self.changed_classes = {}  # Class -> superclass, added, changed and removed methods
+        self.changes = {}  # Class -> set of (kind, selector) to hook
+
+    @classmethod
+    def signatures(cls, interfaces):
+        ''' (kind, selector) -> (return type, argument types...), types are interned '''
+        signatures = {}
+        for interface in interfaces:
+            for kind, attribute in cls.KINDS:
+                for method in getattr(interface, attribute):
+                    signatures[(kind, method.selector)] = (method.return_type,) + tuple(
+                        [arg.class_type for arg in method.arguments]
+                    )
+        return signatures
+
+    @staticmethod
+    def index(items):
+        ''' Class -> [sorted source digests, superclass, interfaces] of the hooked interfaces '''
+        classes = {}
+        for parsed in items:
+            if not parsed.interfaces:
+                continue
+            interface = parsed.interfaces[0]
+            entry = classes.get(interface.class_name)
+            if entry is None:
+                entry = classes[interface.class_name] = [[], interface.superclass, []]
+            entry[0].append(parsed.digest)
+            entry[2].append(interface)
+        for entry in classes.values():
+            entry[0].sort(key=str)
+        return classes
+
+    @staticmethod
+    def describe(signature):
+        return ', '.join(str(objc_type) for objc_type in signature)
+
+    def compare(self, old_items, new_items):
+        old = self.index(old_items)
+        new = self.index(new_items)
+        for class_name, (digests, superclass, interfaces) in new.items():
+            previous = old.get(class_name)
+            if previous is None:
+                self.added_classes.append(class_name)
+                self.changes[class_name] = set(self.signatures(interfaces))
+                continue
+            if None not in digests and previous[0] == digests:
+                continue  # Same source
+            old_signatures = self.signatures(previous[2])
+            signatures = self.signatures(interfaces)
+            if old_signatures == signatures and previous[1] == superclass:
+                continue  # Only comments, ivars or formatting changed
+            added = sorted(key for key in signatures if key not in old_signatures)
+            changed = sorted(key for key in signatures
+                if key in old_signatures and old_signatures[key] != signatures[key])
+            removed = sorted(key for key in old_signatures if key not in signatures)
+            self.changed_classes[class_name] = {
+                'superclass': [previous[1], superclass] if previous[1] != superclass else None,
+                'added': ["%s%s" % key for key in added],
+                'changed': [{
+                    'selector': "%s%s" % key,
+                    'old': self.describe(old_signatures[key]),
+                    'new': self.describe(signatures[key]),
+                } for key in changed],
+                'removed': ["%s%s" % key for key in removed],
+            }
+            if added or changed:
+                self.changes[class_name] = set(added) | set(changed)
+        self.removed_classes = sorted(class_name for class_name in old if class_name not in new)
+        self.added_classes.sort()
+
+    def hooked_items(self, new_items):
+        '''
+        ParsedHeader items with only the added and changed methods, for
+        generate(); the models are copies so nothing is cached for them
+        '''
+        items = []
+        for parsed in new_items:
+            if not parsed.interfaces or parsed.interfaces[0].class_name not in self.changes:
+                continue
+            source = parsed.interfaces[0]
+            keys = self.changes[source.class_name]
+            interface = ObjcInterface(source.class_name, source.superclass, source.protocols, source.category)
+            for kind, attribute in self.KINDS:
+                setattr(interface, attribute, [
+                    method for method in getattr(source, attribute) if (kind, method.selector) in keys
+                ])
+            if interface.class_methods or interface.instance_methods or interface.properties:
+                items.append(ParsedHeader(parsed.header_file, [interface]))
+        return items
+
+    def counts(self):
+        ''' Methods added, changed and removed, over every class '''
+        added = sum(len(self.changes[class_name]) for class_name in self.added_classes)
+        changed = 0
+        removed = 0
+        for change in self.changed_classes.values():
+            added += len(change['added'])
+            changed += len(change['changed'])
+            removed += len(change['removed'])
+        return added, changed, removed
+
+    def report(self):
+        return {
+            'added_classes': self.added_classes,
+            'removed_classes': self.removed_classes,
+            'changed_classes': self.changed_classes,
+        }
+
+
+class TypeIndex(object):
+    '''
+    Hashed index of the types that are safe to use in generated hooks; the
+    built-in Foundation types plus every @interface and @protocol defined
+    in the target headers
+    '''
+
+    def __init__(self):
+        self.classes = set()
+        self.protocols = set()
+        self._digest = None
+        self._known = {}  # ObjcType -> bool, types are interned so there are few
+
+    def __contains__(self, name):
+        return name in KNOWN_TYPES or name in self.classes or name in self.protocols
+
+    def __len__(self):
+        return len(self.classes) + len(self.protocols)
+
+    def scan(self, source_code):
+        ''' Add every type defined in a header, forward declarations are skipped '''
+        for kind, name, rest in TYPE_DEFINITION.findall(source_code):
+            if rest.strip().startswith((';', ',')):
+                continue
+            if kind == 'interface':
+                self.classes.add(name)
+            else:
+                self.protocols.add(name)
+        self._digest = None
+        self._known = {}
+
+    def update(self, other):
+        ''' Add every type of another index '''
+        self.classes.update(other.classes)
+        self.protocols.update(other.protocols)
+        self._digest = None
+        self._known = {}
+
+    def knows(self, objc_type):
+        ''' True if every name in the type is in the index '''
+        known = self._known.get(objc_type)
+        if known is None:
+            known = self._known[objc_type] = objc_type.is_known_in(self)
+        return known
+
+    @property
+    def digest(self):
+        ''' Hash of the index contents, cached output depends on it '''
+        if self._digest is None:
+            digest = hashlib.sha1()
+            for names in (self.classes, self.protocols):
+                digest.update(','.join(sorted(names)).encode('utf-8') + b'\0')
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def forward_declarations(self, methods):
+        ''' @class/@protocol lines for the corpus types used by methods '''
+        names = set()
+        for method in methods:
+            names.update(method.return_type.type_names)
+            for argument in method.arguments:
+                names.update(argument.class_type.type_names)
+        names -= KNOWN_TYPES
+        declarations = ""
+        classes = sorted(names & self.classes)
+        if 0 < len(classes):
+            declarations += "@class %s;\n" % ', '.join(classes)
+        for protocol in sorted(names & self.protocols):
+            declarations += "@protocol %s;\n" % protocol
+        return declarations + "\n" if declarations else declarations
+
+
 class ObjcHeader(object):
     ''' Represents an objective-c header file and it's methods, etc '''
 
-    def __init__(self, file_path, unknowns=True, verbose=False):
+    def __init__(self, file_path, unknowns=True, verbose=False, interfaces=None, section=None):
         self.file_path = os.path.abspath(file_path)
         self.file_name = os.path.basename(self.file_path)
-        self.class_fp = open(self.file_path, 'r')
-        self.source_code = self.class_fp.read()
+        self.source_code = None
+        if section is not None:
+            self.source_code = section.read()
+        elif interfaces is None:
+            with open(self.file_path, 'r') as class_fp:
+                self.source_code = class_fp.read()
         self.verbose = verbose
         self.drop_unknowns = unknowns
-        self._class_name = None
+        self.check_arguments = False
+        self.types = TypeIndex()
+        self._interfaces = interfaces
+        self._known = None
         self._hook_count = 0
+        self.unknowns_skipped = 0
         self.setters = False
         self.getters = False
         self.params = False
         self.debug = False
+        self.log = NSLogBackend()
+        self.throttle = None
+        self.hooked = None
+        self.already_hooked = 0
+        self.inherited = None
+        self.inherited_skipped = 0
+        self.timing = False
+        self.timed = []  # (selector id, "", description) of the hooks that are timed
+        self.filter_time = 0.0  # Spent matching the method filter
 
     @property
-    def class_name(self):
-        ''' Get class name from source code '''
-        if self._class_name is not None:
-            return self._class_name
-        else:
-            for line in self.source_code.split('\n'):
-                if line.startswith('@interface'):
-                    class_name = line.split(' ')[1]
-                    if self.verbose:
-                        print(INFO + "Found class: %s" % class_name)
-                    self._class_name = class_name
-                    return self._class_name
+    def interfaces(self):
+        ''' All @interface models in the file, parsed on first access '''
+        if self._interfaces is None:
+            self._interfaces = self.parse()
+        return self._interfaces
+
+    @property
+    def interface(self):
+        ''' The first @interface in the file, this is what gets hooked '''
+        if not len(self.interfaces):
             raise ValueError("Invalid header syntax, no class name found")
+        return self.interfaces[0]
+
+    @property
+    def class_name(self):
+        return self.interface.class_name
+
+    @property
+    def superclass(self):
+        return self.interface.superclass
+
+    @property
+    def protocols(self):
+        return self.interface.protocols
 
     @property
     def class_methods(self):
-        ''' Parse source code and return list of class methods '''
-        methods = []
-        for line in self.source_code.split('\n'):
-            if line.startswith('+'):
-                method_name = self.get_method_name(line)
-                if self.verbose:
-                    print(INFO + "Hooking class method: %s" % method_name)
-                ret = self.get_return_type(line)
-                if self.drop_unknowns and not ret.is_known:
-                    if self.verbose:
-                        print(WARN + 'Unknown return type; skipping class method "%s"' % method_name)
-                    continue
-                args = self.get_arguments(line)
-                class_method = ObjcMethod(method_name, static=True)
-                class_method.return_type = ret
-                class_method.arguments = args
-                methods.append(class_method)
-        return methods
+        return self.known_methods()['class']
 
     @property
     def instance_methods(self):
-        ''' Parse source code and return a list of instance methods '''
-        methods = []
-        for line in self.source_code.split('\n'):
-            if line.startswith('-'):
-                method_name = self.get_method_name(line)
-                if method_name == '.cxx_destruct' or method_name == 'cxx_construct':
-                    continue
-                if self.verbose:
-                    print(INFO + "Hooking instance method: %s" % method_name)
-                ret = self.get_return_type(line)
-                if self.drop_unknowns and not ret.is_known:
-                    if self.verbose:
-                        print(WARN + 'Unknown return type; skipping instance method "%s"' % method_name)
-                    continue
-                else:
-                    args = self.get_arguments(line)
-                    instance_method = ObjcMethod(method_name)
-                    instance_method.return_type = ret
-                    instance_method.arguments = args
-                    methods.append(instance_method)
-        return methods
+        return self.known_methods()['instance']
 
     @property
     def properties(self):
-        ''' Parse source code and return list of class properties '''
-        _properties = []
+        return self.known_methods()['property']
+
+    def known_methods(self):
+        '''
+        The interface's methods and properties, without the ones that use
+        types missing from the type index (unless unknowns are allowed)
+        '''
+        if self._known is None:
+            self._known = {
+                'class': self.drop_unknown_types(
+                    self.interface.class_methods, "class method"),
+                'instance': self.drop_unknown_types(
+                    self.interface.instance_methods, "instance method"),
+                'property': self.drop_unknown_types(
+                    self.interface.properties, "property"),
+            }
+        return self._known
+
+    def drop_unknown_types(self, methods, kind):
+        ''' Filter out methods with unknown return types, and argument types with --check-arguments '''
+        if not self.drop_unknowns:
+            return methods
+        known = []
+        for method in methods:
+            if not self.types.knows(method.return_type):
+                self.unknowns_skipped += 1
+                if self.verbose:
+                    print(WARN + 'Unknown return type "%s"; skipping %s "%s"' % (
+                        method.return_type, kind, method.method_name,
+                    ))
+            elif self.check_arguments and not all(
+                    self.types.knows(arg.class_type) for arg in method.arguments):
+                self.unknowns_skipped += 1
+                if self.verbose:
+                    print(WARN + 'Unknown argument type; skipping %s "%s"' % (
+                        kind, method.method_name,
+                    ))
+            else:
+                known.append(method)
+        return known
+
+    def statements(self):
+        '''
+        Yield one declaration at a time with comments removed; declarations
+        that span several lines are joined into a single line.
+        '''
+        pending = []
+        in_comment = False
         for line in self.source_code.split('\n'):
-            if line.startswith("@property"):
-                name = self.get_property_name(line)
-                property_type = self.get_property_type(line)
-                if self.drop_unknowns and not property_type.is_known:
-                    if self.verbose:
-                        print(WARN + 'Unknown return type "%s", skipping property "%s"' % (
-                            (property_type.class_name, name,)
-                        ))
-                    continue
-                else:
-                    class_property = ObjcMethod(name)
-                    class_property.return_type = property_type
-                    _properties.append(class_property)
-        return _properties
-
-    def get_method_name(self, line):
-        ''' Get method name from a line of source '''
-        line = line[line.index(")") + 1:]
-        end = line.index(":") if ':' in line else -1
-        return line[:end]
-
-    def get_return_type(self, line):
-        ''' Get the return value from a line of source '''
-        ctype = line[2:line.index(')') + 1]
-        pointer = '*' in ctype
-        return ObjcType(ctype[:-1], pointer=pointer)
-
-    def get_arguments(self, line):
-        ''' Get function arguments from a line of source '''
-        return line[line.index(":"):-1] if ':' in line else ""
-
-    def get_property_name(self, line):
-        ''' Get a property's name from a line of source '''
-        return line.split(" ")[-1][:-1]
-
-    def get_property_type(self, line):
-        ''' Get property type from line of source '''
-        name = line[line.index(")") + 1:line.rindex(" ")]
-        ptr = name.endswith("*")
-        if ptr:  # Cut off "*"
-            name = name[:-1]
-        if name.startswith(" "):
-            return ObjcType(name[1:], pointer=ptr)  
+            line, in_comment = strip_comments(line, in_comment)
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(DECLARATIONS):
+                if 0 < len(pending):
+                    yield ' '.join(pending)  # Unterminated, parse what we have
+                pending = [line]
+            elif 0 < len(pending):
+                pending.append(line)
+            else:
+                continue
+            statement = ' '.join(pending)
+            if is_complete(statement):
+                pending = []
+                yield statement
+        if 0 < len(pending):
+            yield ' '.join(pending)
+
+    def parse(self):
+        ''' Single pass over the source code, returns a list of ObjcInterface '''
+        interfaces = []
+        current = None
+        for statement in self.statements():
+            if statement.startswith('@interface'):
+                current = self.parse_interface(statement)
+                if self.verbose:
+                    print(INFO + "Found class: %s" % current.class_name)
+                interfaces.append(current)
+            elif statement.startswith(('@protocol', '@end')):
+                current = None  # Protocol methods do not belong to a class
+            elif current is None:
+                continue
+            elif statement.startswith('@property'):
+                self.parse_property(current, statement)
+            else:
+                self.parse_method(current, statement)
+        return interfaces
+
+    def parse_interface(self, statement):
+        ''' Parse "@interface Name (Category) : Super <Protocols>" '''
+        match = INTERFACE_DECL.match(statement)
+        if match is None:
+            raise ValueError("Invalid header syntax, no class name found")
+        name, category, superclass, protocols = match.groups()
+        if protocols is not None:
+            protocols = [proto.strip() for proto in protocols.split(',') if proto.strip()]
+        return ObjcInterface(name, superclass, protocols, category)
+
+    def parse_method(self, interface, statement):
+        ''' Parse a "+" or "-" declaration and add it to the interface '''
+        static = statement.startswith('+')
+        text = statement[1:].strip().rstrip(';').strip()
+        ret_type = "id"  # Objective-c default when no type is given
+        try:
+            if text.startswith('('):
+                ret_type, text = split_parens(text)
+            if ':' not in text:
+                method_name = re.match(r'[\w.]*', text).group()
+                arguments = []
+            else:
+                method_name, arguments = parse_selector(text)
+        except ValueError as error:
+            if self.verbose:
+                print(WARN + 'Skipping declaration "%s"; %s' % (statement, error))
+            return
+        if method_name in ['.cxx_destruct', '.cxx_construct']:
+            return
+        kind = "class" if static else "instance"
+        if self.verbose:
+            print(INFO + "Hooking %s method: %s" % (kind, method_name))
+        method = ObjcMethod(method_name, static=static)
+        method.return_type = ObjcType.from_string(ret_type)
+        method.arguments = arguments
+        if static:
+            interface.class_methods.append(method)
         else:
-            return ObjcType(name, pointer=ptr)
+            interface.instance_methods.append(method)
 
-    def filter_methods(self, methods, regex):
+    def parse_property(self, interface, statement):
+        ''' Parse a "@property" declaration and add it to the interface '''
+        match = PROPERTY_DECL.match(statement)
+        if match is None or not match.group(1).strip():
+            if self.verbose:
+                print(WARN + 'Skipping declaration "%s"' % statement)
+            return
+        class_property = ObjcMethod(match.group(2))
+        class_property.return_type = ObjcType.from_string(match.group(1))
+        interface.properties.append(class_property)
+
+    def declarations(self, method_filter=None):
+        '''
+        ("+", selector), ("-", selector) and ("@", property) for everything
+        that passes the type and method filters, i.e. what gets hooked
+        '''
+        kinds = [('+', self.class_methods), ('-', self.instance_methods)]
+        if self.getters or self.setters:
+            kinds.append(('@', self.properties))
+        declarations = []
+        for kind, methods in kinds:
+            if method_filter is not None:
+                methods = self.filter_methods(methods, method_filter)
+            declarations.extend((kind, method.selector) for method in methods)
+        return declarations
+
+    def filter_methods(self, methods, method_filter):
         '''
-        Filter methods based on matching method name  to regular expression
+        Filter methods based on matching method name to a MethodFilter
         '''
-        return [func for func in methods if regex.match(func.method_name)]
+        return [func for func in methods
+            if method_filter.match(func.method_name, self.class_name)]
 
-    def save_hooks(self, output_fp, regex=None):
+    def save_hooks(self, output_fp, method_filter=None):
         ''' Parse an entire class header file '''
         if self.class_name is not None:
             try:
-                if regex is not None:
-                    self.__regex__(output_fp, regex)
+                if method_filter is not None:
+                    self.__regex__(output_fp, method_filter)
                 else:
                     self.__save__(output_fp,
                         self.properties,
@@ -329,18 +1193,35 @@ class ObjcHeader(object):
                 else:
                     print(WARN + "Error while parsing file.")
 
-    def __regex__(self, output_fp, regex):
-        ''' Created hooks based on methods that match a regular expression '''
-        regex = compile_regex(regex)
-        properties = self.filter_methods(self.properties, regex)
-        class_methods = self.filter_methods(self.class_methods, regex)
-        instance_methods = self.filter_methods(self.instance_methods, regex)
+    def __regex__(self, output_fp, method_filter):
+        ''' Created hooks based on methods that match the method filter '''
+        started = time.time()
+        properties = self.filter_methods(self.properties, method_filter)
+        class_methods = self.filter_methods(self.class_methods, method_filter)
+        instance_methods = self.filter_methods(self.instance_methods, method_filter)
+        self.filter_time += time.time() - started
         if 0 < len(properties) + len(class_methods) + len(instance_methods):
             self.__save__(output_fp, properties, class_methods, instance_methods)
 
     def __save__(self, output_fp, properties, class_methods, instance_methods):
         ''' Save hooks to output file '''
+        if self.inherited:
+            declared = len(properties) + len(class_methods) + len(instance_methods)
+            properties = self.drop_inherited(properties, '@')
+            class_methods = self.drop_inherited(class_methods, '+')
+            instance_methods = self.drop_inherited(instance_methods, '-')
+            if 0 < declared and not len(properties) + len(class_methods) + len(instance_methods):
+                return
+        if self.hooked is not None:
+            properties = self.drop_hooked(properties, etters=True)
+            class_methods = self.drop_hooked(class_methods)
+            instance_methods = self.drop_hooked(instance_methods)
+            if not len(properties) + len(class_methods) + len(instance_methods):
+                return
         self.write_header(output_fp)
+        output_fp.write(self.types.forward_declarations(
+            properties + class_methods + instance_methods
+        ))
         output_fp.write("%"+"hook %s\n\n" % self.class_name)
         if self.getters or self.setters:
             self.write_methods(output_fp, properties, etters=True, comment="Properties")
@@ -348,6 +1229,42 @@ class ObjcHeader(object):
         self.write_methods(output_fp, instance_methods, comment="Instance Methods")
         output_fp.write("%"+"end\n\n\n")
 
+    def drop_inherited(self, methods, kind):
+        ''' Drop the methods that are hooked in a superclass instead '''
+        kept = []
+        for method in methods:
+            if (kind, method.selector) not in self.inherited:
+                kept.append(method)
+            elif kind == '@':
+                self.inherited_skipped += len(self.etter_selectors(method))
+            else:
+                self.inherited_skipped += 1
+        return kept
+
+    def drop_hooked(self, methods, etters=False):
+        ''' Drop the methods whose hooks are all in the existing tweak '''
+        kept = []
+        for method in methods:
+            selectors = self.etter_selectors(method) if etters else [method.selector]
+            hooked = [selector for selector in selectors if self.is_hooked(selector)]
+            self.already_hooked += len(hooked)
+            if len(hooked) < len(selectors):
+                kept.append(method)
+        return kept
+
+    def is_hooked(self, selector):
+        return self.hooked is not None and (self.class_name, selector) in self.hooked
+
+    def etter_selectors(self, method):
+        ''' Selectors of the getter and setter hooks for a property '''
+        etter_name = "et" + method.method_name[0].upper() + method.method_name[1:]
+        selectors = []
+        if self.getters:
+            selectors.append("g" + etter_name)
+        if self.setters:
+            selectors.append("s" + etter_name + ":")
+        return selectors
+
     def write_header(self, output_fp):
         ''' Write comment header to output file '''
         output_fp.write("/*==%s\n" % str("=" * len(self.class_name)))
@@ -365,21 +1282,57 @@ class ObjcHeader(object):
                 else:
                     self._hook_count += 1
                     output_fp.write("%s {\n" % str(method))
-                    output_fp.write("    %" + "log;\n")
-                    if self.params:
-                        self.write_params(output_fp, method.arguments)
-                    if 'void' in str(method.return_type):
+                    throttled = self.write_throttle(output_fp, method.method_name, method.method_name)
+                    output_fp.write(throttle_log(
+                        self.log.log_call(self.class_name, method), throttled,
+                    ))
+                    if self.params and not self.log.records_arguments:
+                        self.write_params(output_fp, method.arguments, throttled)
+                    if self.timing:
+                        self.write_timed(output_fp, method)
+                    elif 'void' in str(method.return_type):
                         output_fp.write("    %" + "orig;\n")
                     else:
                         output_fp.write("    return %" + "orig;\n")
                     output_fp.write("}\n\n")
             output_fp.write("\n")
             
-    def write_params(self, output_fp, arguments):
+    def write_timed(self, output_fp, method):
+        ''' Call %orig and add how long it took to the hook's histogram '''
+        output_fp.write("    IH_TIMING_START();\n")
+        if 'void' in str(method.return_type):
+            output_fp.write("    %" + "orig;\n")
+            output_fp.write(self.timing_stop(method_description(self.class_name, method)))
+        else:
+            output_fp.write("    %s ih_result = " % method.return_type + "%" + "orig;\n")
+            output_fp.write(self.timing_stop(method_description(self.class_name, method)))
+            output_fp.write("    return ih_result;\n")
+
+    def timing_stop(self, description):
+        ''' IH_TIMING_STOP() for one hook, its selector is added to the table '''
+        selector = trace_selector(description)
+        self.timed.append((selector, '', description))
+        return "    IH_TIMING_STOP(0x%016xULL);\n" % selector
+
+    def write_params(self, output_fp, arguments, throttled=False):
         for arg in arguments:
-            output_fp.write('    NSLog(@"    [Param]%s -> ' % str(arg))
             printf = "@" if str(arg.class_type) not in NSLOG else NSLOG[str(arg.class_type)]
-            output_fp.write('%' + printf + '", %s);\n' % arg.component)
+            output_fp.write(throttle_log(self.log.log_value(
+                "    [Param]%s -> " % str(arg), printf, arg.component, arg.class_type,
+            ), throttled))
+
+    def write_throttle(self, output_fp, hook_name, method_name):
+        ''' Declare the hook's call counters, returns True if logging is throttled '''
+        if self.throttle is None:
+            return False
+        throttle = self.throttle.for_method(hook_name, self.class_name, method_name)
+        if not throttle.is_active:
+            return False
+        output_fp.write("    static ih_throttle_t ih_state;\n")
+        output_fp.write("    int ih_log = ih_throttle(&ih_state, %d, %d, %d);\n" % (
+            throttle.every, throttle.first, throttle.rate,
+        ))
+        return True
 
     def write_etters(self, output_fp, method):
         '''
@@ -389,111 +1342,2132 @@ class ObjcHeader(object):
         ''' 
         property_name = method.method_name
         etter_name = "et" + property_name[0].upper() + property_name[1:]
-        if self.getters:
+        if self.getters and not self.is_hooked("g" + etter_name):
             self._hook_count += 1
             output_fp.write("-(%s) " % method.return_type)
             output_fp.write("g%s {\n" % etter_name)
+            throttled = self.write_throttle(output_fp, "g" + etter_name, property_name)
             if self.debug:
-                output_fp.write('    NSLog(@" >>> Enter %s Getter >>>");\n' % property_name)
+                output_fp.write(throttle_log(self.log.log_message(
+                    " >>> Enter %s Getter >>>" % property_name,
+                    "-[%s g%s] enter" % (self.class_name, etter_name),
+                ), throttled))
+            if self.timing:
+                output_fp.write("    IH_TIMING_START();\n")
             output_fp.write("    %s %s = " % (method.return_type, property_name))
             output_fp.write("%" + "orig;\n")
-            output_fp.write('    NSLog(@"[<- Getter](%s) %s: ' % (str(method.return_type), property_name))
+            if self.timing:
+                output_fp.write(self.timing_stop("-[%s g%s]" % (self.class_name, etter_name)))
             printf = "@" if str(method.return_type) not in NSLOG else NSLOG[str(method.return_type)]
-            output_fp.write('%'+'%s", %s);\n' % (printf, property_name))
+            output_fp.write(throttle_log(self.log.log_value(
+                "[<- Getter](%s) %s: " % (str(method.return_type), property_name),
+                printf, property_name, method.return_type,
+                "-[%s g%s]" % (self.class_name, etter_name),
+            ), throttled))
             output_fp.write('    return %s;\n' % property_name)
             output_fp.write("}\n")
-        if self.setters:
+        if self.setters and not self.is_hooked("s" + etter_name + ":"):
             self._hook_count += 1
             output_fp.write("-(void) s"+etter_name+": ")
             output_fp.write("(%s)%s {\n" % (method.return_type, property_name))
+            throttled = self.write_throttle(output_fp, "s" + etter_name, property_name)
             if self.debug:
-                output_fp.write('    NSLog(@" >>> Enter %s Setter >>>");\n' % property_name)
-            output_fp.write('    NSLog(@"[Setter ->](%s) %s: ' % (str(method.return_type), property_name))
+                output_fp.write(throttle_log(self.log.log_message(
+                    " >>> Enter %s Setter >>>" % property_name,
+                    "-[%s s%s:] enter" % (self.class_name, etter_name),
+                ), throttled))
             printf = "@" if str(method.return_type) not in NSLOG else NSLOG[str(method.return_type)]
-            output_fp.write('%'+'%s", %s);\n' % (printf, property_name))
+            output_fp.write(throttle_log(self.log.log_value(
+                "[Setter ->](%s) %s: " % (str(method.return_type), property_name),
+                printf, property_name, method.return_type,
+                "-[%s s%s:]" % (self.class_name, etter_name),
+            ), throttled))
+            if self.timing:
+                output_fp.write("    IH_TIMING_START();\n")
             output_fp.write('    %'+'orig(%s);\n' % property_name)
+            if self.timing:
+                output_fp.write(self.timing_stop("-[%s s%s:]" % (self.class_name, etter_name)))
             output_fp.write('}\n')
         output_fp.write('\n')
 
 
-### Functions
-def display_info(msg):
-    ''' Clearline and print message '''
-    sys.stdout.write(chr(27) + '[2K')
-    sys.stdout.write('\r' + INFO + msg)
-    sys.stdout.flush()
+class NSLogBackend(object):
+    ''' Log with %log and NSLog(), simple but synchronous on the hooked thread '''
 
-def compile_regex(expression):
-    ''' Ensures we got a valid regex from user '''
-    try:
-        return re.compile(expression)
-    except:
-        print(WARN + "Invalid regular expression")
-        os._exit(1)
+    name = 'nslog'
+    records_arguments = False  # True if log_call() already logs the arguments
+    selectors = ()
 
-def write_includes(output_fp):
-    ''' Add basic includes to the tweak '''
-    output_fp.write('#import <CoreFoundation/CoreFoundation.h>\n')
-    output_fp.write('#import <Foundation/Foundation.h>\n')
-    output_fp.write('#import <Security/Security.h>\n')
-    output_fp.write('#import <Security/SecCertificate.h>\n')
-    output_fp.write('\n')
-    output_fp.write('#import "substrate.h"\n')
-    output_fp.write('\n\n')
+    def prelude(self):
+        ''' Code needed once at the top of every tweak file '''
+        return ""
 
-def write_load_hook(output_fp):
-    ''' Log on Dylib load '''
-    output_fp.write("/* Dylib Constructor */\n")
-    output_fp.write("%"+"ctor {\n")
-    output_fp.write('    NSLog(@" --- iOS Hooker Loaded: %ss --- ", __FILE__);\n' % "%")
-    output_fp.write("}\n\n")
+    def log_call(self, class_name, method):
+        return "    %" + "log;\n"
 
-def parser_headers(ls, output_fp, args):
-    ''' Parse list of header files '''
-    errors = 0
-    total_hooks = 0
-    for index, header_file in enumerate(ls):
-        display_info("Parsing %d of %d files: %s... " % (
-            index + 1, len(ls), header_file[:-2],
+    def log_message(self, message, event=None):
+        ''' event names the message for backends that identify events by name '''
+        return '    NSLog(@"%s");\n' % message
+
+    def log_value(self, message, printf, expression, objc_type=None, event=None):
+        return '    NSLog(@"%s%%%s", %s);\n' % (message, printf, expression)
+
+
+class OSLogBackend(NSLogBackend):
+    ''' Log with os_log() and static format strings '''
+
+    name = 'oslog'
+    FORMATS = {
+        'i': ('%lld', '(long long)'), 'u': ('%llu', '(unsigned long long)'),
+        'f': ('%g', '(double)'), 'o': ('%{public}@', ''), 'p': ('%p', '(void *)'),
+    }
+
+    def prelude(self):
+        return "#import <os/log.h>\n\n"
+
+    def log_call(self, class_name, method):
+        return self.log_message(method_description(class_name, method))
+
+    def log_message(self, message, event=None):
+        return '    os_log(OS_LOG_DEFAULT, "%s");\n' % message
+
+    def log_value(self, message, printf, expression, objc_type=None, event=None):
+        kind = value_kind(printf, objc_type)
+        if kind is None:
+            return self.log_message(message)  # Structs and other values os_log can't format
+        log_format, cast = self.FORMATS[kind]
+        return '    os_log(OS_LOG_DEFAULT, "%s%s", %s(%s));\n' % (
+            message, log_format, cast, expression,
+        )
+
+
+class RingLogBackend(NSLogBackend):
+    '''
+    Log into a preallocated lock-free ring buffer that a background
+    dispatch queue drains to os_log(); the hooked thread never formats
+    '''
+
+    name = 'ring'
+    MACROS = {
+        'i': 'IH_LOG_INT', 'u': 'IH_LOG_UINT', 'f': 'IH_LOG_DOUBLE',
+        'o': 'IH_LOG_OBJECT', 'p': 'IH_LOG_POINTER',
+    }
+
+    def prelude(self):
+        return RING_LOG_RUNTIME
+
+    def log_call(self, class_name, method):
+        return self.log_message(method_description(class_name, method))
+
+    def log_message(self, message, event=None):
+        return '    IH_LOG("%s");\n' % message
+
+    def log_value(self, message, printf, expression, objc_type=None, event=None):
+        kind = value_kind(printf, objc_type)
+        if kind is None:
+            return self.log_message(message)  # Structs and other values that don't fit a slot
+        return '    %s("%s", %s);\n' % (self.MACROS[kind], message, expression)
+
+
+class TraceLogBackend(NSLogBackend):
+    '''
+    Write fixed-size binary records to a memory-mapped file on the device;
+    each has a selector id from the table written next to the tweak and the
+    first arguments as raw scalars, so the hooked thread never formats
+    '''
+
+    name = 'trace'
+    records_arguments = True
+    MACROS = {
+        'i': 'IH_TRACE_INT', 'u': 'IH_TRACE_UINT', 'f': 'IH_TRACE_DOUBLE',
+        'o': 'IH_TRACE_OBJECT', 'p': 'IH_TRACE_POINTER',
+    }
+
+    def __init__(self):
+        self.selectors = []
+
+    def prelude(self):
+        return TRACE_RUNTIME
+
+    def log_call(self, class_name, method):
+        return self.record(method_description(class_name, method), [
+            (trace_kind(arg.class_type), arg.component)
+            for arg in method.arguments[:TRACE_ARGS]
+        ])
+
+    def log_message(self, message, event=None):
+        return self.record(message if event is None else event, [])
+
+    def log_value(self, message, printf, expression, objc_type=None, event=None):
+        return self.record(message if event is None else event, [
+            (value_kind(printf, objc_type), expression),
+        ])
+
+    def record(self, description, values):
+        ''' IH_TRACE() for one event, its selector is added to the table '''
+        description = description.strip()
+        selector = trace_selector(description)
+        self.selectors.append((selector, ''.join(kind or '-' for kind, _ in values), description))
+        arguments = [
+            "%s(%s)" % (self.MACROS[kind], expression) if kind else "0"
+            for kind, expression in values
+        ]
+        arguments += ["0"] * (TRACE_ARGS - len(arguments))
+        return '    IH_TRACE(0x%016xULL, %s);\n' % (selector, ', '.join(arguments))
+
+
+LOG_BACKENDS = dict(
+    (backend.name, backend)
+    for backend in [NSLogBackend, OSLogBackend, RingLogBackend, TraceLogBackend]
+)
+
+
+class Throttle(object):
+    ''' Log 1-in-N calls, at most K per second and/or only the first M calls '''
+
+    def __init__(self, every=0, rate=0, first=0):
+        self.every = every
+        self.rate = rate
+        self.first = first
+
+    @classmethod
+    def from_string(cls, spec):
+        ''' Parse "every:100,rate:10,first:5" '''
+        values = {}
+        for part in spec.split(','):
+            key, _, value = part.partition(':')
+            if key.strip() not in ['every', 'rate', 'first']:
+                raise ValueError("Unknown throttle setting '%s'" % key)
+            values[key.strip()] = int(value)
+            if values[key.strip()] < 0:
+                raise ValueError("'%s' must be 0 or more" % key.strip())
+        return cls(**values)
+
+    @property
+    def is_active(self):
+        return 1 < self.every or 0 < self.rate or 0 < self.first
+
+    def __str__(self):
+        return "every:%d,rate:%d,first:%d" % (self.every, self.rate, self.first)
+
+
+class ThrottleRules(object):
+    ''' The global throttle plus overrides for selectors matching a pattern '''
+
+    def __init__(self, default, overrides=None):
+        self.default = default
+        self.profile = None  # Hot selectors from a CallProfile, if any
+        self.overrides = []
+        for pattern, throttle in overrides or []:
+            self.overrides.append((compile_regex(pattern), throttle))
+
+    @property
+    def is_active(self):
+        return self.default.is_active or self.profile is not None or any(
+            throttle.is_active for regex, throttle in self.overrides
+        )
+
+    def for_method(self, hook_name, class_name=None, method_name=None):
+        '''
+        Throttle for a hook; hook_name is what the generated hook is called
+        and method_name the method or property it was generated for
+        '''
+        method_name = method_name if method_name is not None else hook_name
+        if self.profile is not None and self.profile.is_hot(class_name, method_name):
+            return self.profile.hot_throttle
+        for regex, throttle in self.overrides:
+            if regex.match(hook_name):
+                return throttle
+        return self.default
+
+    def __str__(self):
+        return "%s %s %s" % (self.default, [
+            (regex.pattern, str(throttle)) for regex, throttle in self.overrides
+        ], self.profile)
+
+
+class PatternSet(object):
+    '''
+    Method name patterns compiled once and shared by every header; plain
+    selector names go into a literal-prefix index and the rest are joined
+    into a single regular expression, so matching stays flat as the list
+    of patterns grows.  Patterns with inline flags or group references
+    change meaning when joined, those are matched on their own
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.literals = set()
+        self.regexes = []
+        expressions = []
+        default_flags = re.compile('').flags
+        for pattern in self.patterns:
+            if LITERAL_SELECTOR.match(pattern):
+                self.literals.add(pattern)
+                continue
+            regex = compile_regex(pattern)  # Report the bad pattern, not the union
+            if regex.flags != default_flags or GROUP_REFERENCE.search(pattern):
+                self.regexes.append(regex)
+            else:
+                expressions.append("(?:%s)" % pattern)
+        self.lengths = sorted(set(len(literal) for literal in self.literals))
+        self.regex = None
+        if 0 < len(expressions):
+            try:
+                self.regex = re.compile('|'.join(expressions))
+            except re.error:
+                self.regexes.extend(re.compile(expression) for expression in expressions)
+
+    def match(self, name):
+        ''' Same semantics as re.match(), patterns are anchored at the start '''
+        for length in self.lengths:
+            if name[:length] in self.literals:
+                return True
+        if self.regex is not None and self.regex.match(name) is not None:
+            return True
+        return any(regex.match(name) is not None for regex in self.regexes)
+
+
+class MethodFilter(object):
+    ''' Include and exclude method name patterns '''
+
+    def __init__(self, include=None, exclude=None):
+        self.include = PatternSet(include) if include else None
+        self.exclude = PatternSet(exclude) if exclude else None
+        self.profile = None  # Drop methods a CallProfile says to drop
+
+    def match(self, method_name, class_name=None):
+        if self.include is not None and not self.include.match(method_name):
+            return False
+        if self.profile is not None and not self.profile.keeps(class_name, method_name):
+            return False
+        return self.exclude is None or not self.exclude.match(method_name)
+
+    def __str__(self):
+        return repr((
+            self.include.patterns if self.include is not None else [],
+            self.exclude.patterns if self.exclude is not None else [],
+            str(self.profile),
         ))
-        if args.verbose:
-            sys.stdout.write('\n')
-        try:
-            objc = ObjcHeader(header_file, args.unknowns, args.verbose)
-            objc.setters = args.setters
-            objc.getters = args.getters
-            objc.params = args.params
-            objc.debug = args.debug
-            objc.save_hooks(output_fp, args.method_regex)
-            total_hooks += objc._hook_count
-        except ValueError as error:
-            errors += 1
-            if args.verbose:
-                print(WARN + "Error: Invalid objective-c header file; %s" % error)
-    display_info("Successfully parsed %d of %d file(s)\n" % (
-        len(ls) - errors, len(ls),
-    ))
-    print(INFO + "Generated %d function hook(s)" % total_hooks)
 
-def scan_directory(class_dir, args):
-    ''' Scan directory and parse header files '''
-    path = os.path.abspath(class_dir)
-    ls = filter(lambda file_name: file_name.endswith('.h'), os.listdir(path))
-    if not args.next_step:
-        ls = filter(lambda file_name: not file_name[:-2] in KNOWN_TYPES, ls)
-    if args.file_regex is not None:
-        regular_expression = compile_regex(args.file_regex)
-        ls = filter(regular_expression.match, ls)
-    print(INFO + "Found %s target file(s) in target directory" % len(ls))
-    return ls
 
+class CallProfile(object):
+    '''
+    Calls per class and method counted from captured hook logs; property
+    getter/setter lines don't name their class so they count for any class
+    '''
 
-### Main
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='Generate hooks for an objc class header file',
-    )
-    parser.add_argument('--version',
+    def __init__(self, hot_calls=10000, min_calls=1, hot_action='throttle', hot_throttle=None):
+        self.hot_calls = hot_calls
+        self.min_calls = min_calls
+        self.hot_action = hot_action
+        self.hot_throttle = hot_throttle if hot_throttle is not None else Throttle(rate=1)
+        self.counts = {}
+        self.matches = 0
+        self._digest = None
+
+    def read(self, log_path):
+        ''' Count the calls in a log; memory-mapped so size doesn't matter '''
+        with open(log_path, 'rb') as log_fp:
+            try:
+                data = mmap.mmap(log_fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                data = None  # Empty file, pipe, etc.
+            if data is None:
+                for line in log_fp:
+                    self.scan(line)
+            else:
+                try:
+                    self.scan(data)
+                finally:
+                    data.close()
+        self._digest = None
+
+    def scan(self, data):
+        counts = self.counts
+        for match in LOG_CALL.finditer(data):
+            class_name, method_name, property_name = match.groups()
+            key = (class_name, method_name) if property_name is None else (None, property_name)
+            counts[key] = counts.get(key, 0) + 1
+            self.matches += 1
+
+    def finish(self):
+        ''' Decode the byte strings collected while scanning '''
+        self.counts = dict(
+            ((None if class_name is None else class_name.decode('utf-8'),
+              method_name.decode('utf-8')), count)
+            for (class_name, method_name), count in self.counts.items()
+        )
+        self._digest = None
+
+    def calls(self, class_name, method_name):
+        return self.counts.get((class_name, method_name), 0) + \
+            self.counts.get((None, method_name), 0)
+
+    def is_hot(self, class_name, method_name):
+        return self.hot_calls <= self.calls(class_name, method_name)
+
+    def keeps(self, class_name, method_name):
+        ''' False for methods that were called too little, or too much '''
+        calls = self.calls(class_name, method_name)
+        if calls < self.min_calls:
+            return False
+        return not (self.hot_action == 'exclude' and self.hot_calls <= calls)
+
+    def hottest(self, count=10):
+        return heapq.nlargest(count, self.counts.items(), key=lambda item: item[1])
+
+    def __str__(self):
+        if self._digest is None:
+            digest = hashlib.sha1(repr((
+                self.hot_calls, self.min_calls, self.hot_action, str(self.hot_throttle),
+            )).encode('utf-8'))
+            for key, count in sorted(self.counts.items(), key=repr):
+                digest.update(repr((key, count)).encode('utf-8'))
+            self._digest = digest.hexdigest()
+        return self._digest
+
+
+class TraceReader(object):
+    '''
+    Memory-mapped reader for the binary traces written by the trace log
+    backend; records come back in batches, numpy arrays when available
+    '''
+
+    def __init__(self, trace_path):
+        self.trace_path = trace_path
+        self.data = None
+        with open(trace_path, 'rb') as trace_fp:
+            try:
+                self.data = mmap.mmap(trace_fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                raise ValueError("%s is empty or can't be memory-mapped" % trace_path)
+        if len(self.data) < TRACE_HEADER.size:
+            self.close()
+            raise ValueError("%s is not an ios-hooker trace" % trace_path)
+        magic, version, record_size, capacity, head, numer, denom = \
+            TRACE_HEADER.unpack_from(self.data)
+        if magic != TRACE_MAGIC or record_size != TRACE_RECORD.size:
+            self.close()
+            raise ValueError("%s is not an ios-hooker trace" % trace_path)
+        mapped = (len(self.data) - TRACE_HEADER.size) // TRACE_RECORD.size
+        self.count = min(head, capacity, mapped)
+        self.dropped = head - min(head, capacity)
+        self.nanoseconds_per_tick = numer / float(denom) if denom else 1.0
+
+    def seconds(self, ticks):
+        return ticks * self.nanoseconds_per_tick / 1e9
+
+    def offset(self, index):
+        return TRACE_HEADER.size + index * TRACE_RECORD.size
+
+    def batches(self, batch_size=1024 * 1024):
+        '''
+        Yield every record in order, batch_size at a time; a numpy array
+        viewing the mapped file or a list of tuples without numpy
+        '''
+        for start in range(0, self.count, batch_size):
+            count = min(batch_size, self.count - start)
+            if numpy is not None:
+                yield numpy.frombuffer(self.data, TRACE_DTYPE, count, self.offset(start))
+            elif hasattr(TRACE_RECORD, 'iter_unpack'):
+                view = memoryview(self.data)[self.offset(start):self.offset(start + count)]
+                try:
+                    yield list(TRACE_RECORD.iter_unpack(view))
+                finally:
+                    view.release()
+            else:
+                yield [
+                    TRACE_RECORD.unpack_from(self.data, self.offset(index))
+                    for index in range(start, start + count)
+                ]
+
+    def records(self):
+        ''' Yield (timestamp, thread, selector, args) one record at a time '''
+        for index in range(self.count):
+            record = TRACE_RECORD.unpack_from(self.data, self.offset(index))
+            yield record[0], record[1], record[2], record[3:]
+
+    def close(self):
+        if self.data is not None:
+            try:
+                self.data.close()
+            except BufferError:
+                pass  # A batch still views the map, it's closed with the batch
+            self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class TraceStats(object):
+    '''
+    Events per selector and per thread of one or more traces, aggregated a
+    batch at a time; selector id 0 marks a record that was still being
+    written when the trace was copied
+    '''
+
+    def __init__(self):
+        self.selectors = {}  # id -> [events, first timestamp, last timestamp]
+        self.threads = {}
+        self.events = 0
+        self.unfinished = 0
+        self.dropped = 0
+        self.first = None
+        self.last = None
+        self.nanoseconds_per_tick = 1.0
+
+    def add(self, batch):
+        if numpy is not None and isinstance(batch, numpy.ndarray):
+            self.add_array(batch)
+        else:
+            self.add_records(batch)
+
+    def add_array(self, batch):
+        finished = batch[batch['selector'] != 0]
+        self.unfinished += len(batch) - len(finished)
+        if not len(finished):
+            return
+        order = numpy.argsort(finished['selector'], kind='mergesort')
+        selectors = finished['selector'][order]
+        timestamps = finished['timestamp'][order]
+        starts = numpy.flatnonzero(numpy.r_[True, selectors[1:] != selectors[:-1]])
+        counts = numpy.diff(numpy.r_[starts, len(selectors)])
+        firsts = numpy.minimum.reduceat(timestamps, starts)
+        lasts = numpy.maximum.reduceat(timestamps, starts)
+        for selector, count, first, last in zip(
+                selectors[starts].tolist(), counts.tolist(), firsts.tolist(), lasts.tolist()):
+            self.count(selector, count, first, last)
+        threads, counts = numpy.unique(finished['thread'], return_counts=True)
+        for thread, count in zip(threads.tolist(), counts.tolist()):
+            self.threads[thread] = self.threads.get(thread, 0) + count
+
+    def add_records(self, batch):
+        for record in batch:
+            timestamp, thread, selector = record[:3]
+            if not selector:
+                self.unfinished += 1
+                continue
+            self.count(selector, 1, timestamp, timestamp)
+            self.threads[thread] = self.threads.get(thread, 0) + 1
+
+    def count(self, selector, events, first, last):
+        entry = self.selectors.get(selector)
+        if entry is None:
+            self.selectors[selector] = [events, first, last]
+        else:
+            entry[0] += events
+            entry[1] = min(entry[1], first)
+            entry[2] = max(entry[2], last)
+        self.events += events
+        self.first = first if self.first is None else min(self.first, first)
+        self.last = last if self.last is None else max(self.last, last)
+
+    @property
+    def duration(self):
+        ''' Seconds between the first and last event '''
+        if self.first is None:
+            return 0.0
+        return (self.last - self.first) * self.nanoseconds_per_tick / 1e9
+
+    def busiest(self, count=20):
+        return heapq.nlargest(count, self.selectors.items(), key=lambda item: item[1][0])
+
+    def report(self, table, count=20):
+        ''' JSON-friendly summary, table maps selector ids to descriptions '''
+        duration = self.duration
+        busiest = []
+        for selector, (events, first, last) in self.busiest(count):
+            busiest.append({
+                'selector': "%016x" % selector,
+                'description': table.get(selector, ('', "<unknown selector>"))[1],
+                'events': events,
+                'per_second': events / duration if duration else 0.0,
+                'first': (first - self.first) * self.nanoseconds_per_tick / 1e9,
+                'last': (last - self.first) * self.nanoseconds_per_tick / 1e9,
+            })
+        return {
+            'events': self.events, 'dropped': self.dropped, 'unfinished': self.unfinished,
+            'duration': duration, 'threads': len(self.threads),
+            'selectors': len(self.selectors), 'busiest': busiest,
+        }
+
+
+class TimingHistograms(object):
+    '''
+    Latency histograms of hooked methods merged from the dumps of one or
+    more processes; bucket b counts calls of 2^(b-1) to 2^b nanoseconds
+    '''
+
+    def __init__(self):
+        self.selectors = {}  # id -> [calls, total nanoseconds, buckets]
+        self.dumps = 0
+
+    def read(self, dump_path):
+        with open(dump_path, 'r') as dump_fp:
+            for line in dump_fp:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                selector, calls, total, buckets = line.split('\t')
+                self.add(int(selector, 16), int(calls), int(total),
+                    [int(count) for count in buckets.split(',')])
+        self.dumps += 1
+
+    def add(self, selector, calls, total, buckets):
+        entry = self.selectors.get(selector)
+        if entry is None:
+            self.selectors[selector] = [calls, total, list(buckets)]
+            return
+        entry[0] += calls
+        entry[1] += total
+        if len(entry[2]) < len(buckets):
+            entry[2].extend([0] * (len(buckets) - len(entry[2])))
+        for bucket, count in enumerate(buckets):
+            entry[2][bucket] += count
+
+    @staticmethod
+    def percentile(buckets, fraction):
+        ''' Nanoseconds below which a fraction of the calls took, interpolated in the bucket '''
+        calls = sum(buckets)
+        if not calls:
+            return 0.0
+        rank = fraction * calls
+        seen = 0
+        for bucket, count in enumerate(buckets):
+            if count and rank <= seen + count:
+                low = 0.0 if bucket == 0 else float(1 << (bucket - 1))
+                high = 1.0 if bucket == 0 else float(1 << bucket)
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return float(1 << (len(buckets) - 1))
+
+    def report(self, table, count=20, sort='p99'):
+        ''' JSON-friendly summary of the slowest hooks, table maps selector ids to descriptions '''
+        entries = []
+        for selector, (calls, total, buckets) in self.selectors.items():
+            if not calls:
+                continue
+            entries.append({
+                'selector': "%016x" % selector,
+                'description': table.get(selector, ('', "<unknown selector>"))[1],
+                'calls': calls,
+                'total': total,
+                'mean': total / float(calls),
+                'p50': self.percentile(buckets, 0.5),
+                'p90': self.percentile(buckets, 0.9),
+                'p99': self.percentile(buckets, 0.99),
+            })
+        slowest = heapq.nlargest(count, entries, key=lambda entry: entry[sort])
+        return {'dumps': self.dumps, 'selectors': len(entries), 'slowest': slowest}
+
+
+class MethodDatabase(object):
+    '''
+    Indexed SQLite database of every parsed class, method, argument and
+    property; written with --export-db and searched by the query subcommand
+    without parsing any headers again
+    '''
+
+    SCHEMA = """
+        CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT NOT NULL);
+        CREATE TABLE classes (
+            id INTEGER PRIMARY KEY, name TEXT NOT NULL, superclass TEXT,
+            category TEXT, protocols TEXT NOT NULL, file_id INTEGER NOT NULL
+        );
+        CREATE TABLE methods (
+            id INTEGER PRIMARY KEY, class_id INTEGER NOT NULL, kind TEXT NOT NULL,
+            name TEXT NOT NULL, selector TEXT NOT NULL, return_type TEXT NOT NULL
+        );
+        CREATE TABLE arguments (
+            method_id INTEGER NOT NULL, position INTEGER NOT NULL,
+            label TEXT NOT NULL, type TEXT NOT NULL, name TEXT NOT NULL
+        );
+        CREATE TABLE types (name TEXT NOT NULL, kind TEXT NOT NULL);
+    """
+    INDEXES = """
+        CREATE INDEX classes_name ON classes (name);
+        CREATE INDEX classes_superclass ON classes (superclass);
+        CREATE INDEX methods_class ON methods (class_id);
+        CREATE INDEX methods_selector ON methods (selector);
+        CREATE INDEX methods_return_type ON methods (return_type);
+        CREATE INDEX arguments_method ON arguments (method_id);
+        CREATE INDEX arguments_type ON arguments (type, method_id);
+    """
+    KINDS = ('class', 'instance', 'property')
+
+    def __init__(self, db_path, create=False):
+        self.db_path = os.path.abspath(db_path)
+        self.temp_path = None
+        if create:
+            # Built next to the target and renamed over it once complete
+            self.temp_path = "%s.%d.tmp" % (self.db_path, os.getpid())
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+            self.connection = sqlite3.connect(self.temp_path)
+            self.connection.execute('PRAGMA journal_mode = OFF')
+            self.connection.execute('PRAGMA synchronous = OFF')
+            self.connection.executescript(self.SCHEMA)
+        elif not os.path.exists(self.db_path):
+            raise IOError("No such database: %s" % db_path)
+        else:
+            self.connection = sqlite3.connect(self.db_path)
+        self.connection.text_factory = str  # Not unicode on Python 2, for intern()
+        self.classes = 0
+        self.methods = 0
+
+    def add(self, header_file, interfaces):
+        ''' Insert the parsed models of one header '''
+        cursor = self.connection.cursor()
+        cursor.execute('INSERT INTO files (path) VALUES (?)', (header_file,))
+        file_id = cursor.lastrowid
+        for interface in interfaces:
+            cursor.execute(
+                'INSERT INTO classes (name, superclass, category, protocols, file_id) '
+                'VALUES (?, ?, ?, ?, ?)', (
+                    interface.class_name, interface.superclass, interface.category,
+                    ', '.join(interface.protocols), file_id,
+                ),
+            )
+            class_id = cursor.lastrowid
+            self.classes += 1
+            for kind, methods in zip(self.KINDS, (
+                    interface.class_methods, interface.instance_methods, interface.properties)):
+                for method in methods:
+                    cursor.execute(
+                        'INSERT INTO methods (class_id, kind, name, selector, return_type) '
+                        'VALUES (?, ?, ?, ?, ?)', (
+                            class_id, kind, method.method_name, method.selector,
+                            str(method.return_type),
+                        ),
+                    )
+                    method_id = cursor.lastrowid
+                    self.methods += 1
+                    cursor.executemany(
+                        'INSERT INTO arguments (method_id, position, label, type, name) '
+                        'VALUES (?, ?, ?, ?, ?)', [
+                            (method_id, position, arg.external_name, str(arg.class_type), arg.component)
+                            for position, arg in enumerate(method.arguments)
+                        ],
+                    )
+
+    def add_types(self, type_index):
+        self.connection.executemany('INSERT INTO types (name, kind) VALUES (?, ?)',
+            [(name, 'class') for name in sorted(type_index.classes)] +
+            [(name, 'protocol') for name in sorted(type_index.protocols)]
+        )
+
+    def types(self):
+        ''' The TypeIndex of the run that wrote the database '''
+        type_index = TypeIndex()
+        for name, kind in self.connection.execute('SELECT name, kind FROM types'):
+            if kind == 'class':
+                type_index.classes.add(name)
+            else:
+                type_index.protocols.add(name)
+        return type_index
+
+    def search(self, returns=None, takes=(), selector=None, class_name=None, kind=None,
+            subclass_of=None, source=None):
+        '''
+        Methods that match every given condition; types are compared after
+        normalizing, selector, class_name and source are GLOB patterns
+        '''
+        sql = ""
+        where = []
+        params = []
+        if subclass_of is not None:
+            sql += ('WITH RECURSIVE subclasses (name) AS (SELECT ? UNION '
+                'SELECT classes.name FROM classes JOIN subclasses ON classes.superclass = subclasses.name) ')
+            params.append(subclass_of)
+            where.append('c.name IN subclasses')
+        sql += ('SELECT m.id, c.id, c.name, c.superclass, c.category, c.protocols, f.path, '
+            'm.kind, m.name, m.selector, m.return_type FROM methods m '
+            'JOIN classes c ON c.id = m.class_id JOIN files f ON f.id = c.file_id')
+        if returns is not None:
+            where.append('m.return_type = ?')
+            params.append(str(ObjcType.from_string(returns)))
+        for objc_type in takes:
+            where.append('m.id IN (SELECT method_id FROM arguments WHERE type = ?)')
+            params.append(str(ObjcType.from_string(objc_type)))
+        for column, value in (('m.selector', selector), ('c.name', class_name), ('f.path', source)):
+            if value is not None:
+                where.append('%s GLOB ?' % column)
+                params.append(value)
+        if kind is not None:
+            where.append('m.kind = ?')
+            params.append(kind)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self.connection.execute(sql + ' ORDER BY m.id', params).fetchall()
+
+    def interfaces(self, rows):
+        '''
+        Rebuild the models of the methods found by search() as one
+        ParsedHeader per class, that render_header() hooks without
+        reading the header
+        '''
+        arguments = {}
+        method_ids = [row[0] for row in rows]
+        for start in range(0, len(method_ids), 500):
+            chunk = method_ids[start:start + 500]
+            for method_id, label, objc_type, name in self.connection.execute(
+                    'SELECT method_id, label, type, name FROM arguments WHERE method_id IN (%s) '
+                    'ORDER BY method_id, position' % ', '.join('?' * len(chunk)), chunk):
+                arguments.setdefault(method_id, []).append(ObjcArgument(objc_type, name, label))
+        items = []
+        classes = {}
+        for row in rows:
+            method_id, class_id, class_name, superclass, category, protocols, path, kind, name = row[:9]
+            interface = classes.get(class_id)
+            if interface is None:
+                interface = classes[class_id] = ObjcInterface(
+                    class_name, superclass, protocols.split(', ') if protocols else [], category,
+                )
+                items.append(ParsedHeader(path, [interface]))
+            method = ObjcMethod(name, static=kind == 'class')
+            method.return_type = ObjcType.from_string(row[10])
+            method.arguments = arguments.get(method_id, [])
+            if kind == 'class':
+                interface.class_methods.append(method)
+            elif kind == 'instance':
+                interface.instance_methods.append(method)
+            else:
+                interface.properties.append(method)
+        return items
+
+    def commit(self):
+        ''' Index, close and move the finished database into place '''
+        self.connection.executescript(self.INDEXES)
+        self.connection.commit()
+        self.connection.close()
+        if hasattr(os, 'replace'):
+            os.replace(self.temp_path, self.db_path)
+        else:
+            if os.path.exists(self.db_path):
+                os.remove(self.db_path)
+            os.rename(self.temp_path, self.db_path)
+
+    def abort(self):
+        self.connection.close()
+        if self.temp_path is not None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class HeaderCache(object):
+    '''
+    On-disk cache of parsed interface models and rendered hooks, entries
+    are keyed by a hash of the header contents and the output options
+    '''
+
+    def __init__(self, cache_dir, max_size=512 * 1024 * 1024):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            if not os.path.isdir(self.cache_dir):
+                raise
+
+    def key(self, *parts):
+        ''' Hash any number of strings into a cache key '''
+        digest = hashlib.sha1(str(CACHE_VERSION).encode('utf-8'))
+        for part in parts:
+            digest.update(b'\0' + str(part).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:])
+
+    def get(self, key):
+        ''' Returns the cached value, or None if there is no usable entry '''
+        entry_path = self.path(key)
+        try:
+            with open(entry_path, 'rb') as entry_fp:
+                value = pickle.load(entry_fp)
+            os.utime(entry_path, None)  # Eviction drops the least recently used
+            return value
+        except Exception:
+            return None
+
+    def put(self, key, value):
+        ''' Write an entry atomically, so readers never see a partial file '''
+        entry_path = self.path(key)
+        entry_dir = os.path.dirname(entry_path)
+        temp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        try:
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir)
+            with open(temp_path, 'wb') as entry_fp:
+                pickle.dump(value, entry_fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, entry_path)
+        except (IOError, OSError):
+            pass  # Another process created the directory or cache is read-only
+
+    def evict(self):
+        ''' Remove least recently used entries until the cache fits max_size '''
+        entries = []
+        total_size = 0
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file_name in files:
+                entry_path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_size += stat.st_size
+        removed = 0
+        for mtime, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total_size -= size
+            removed += 1
+        return removed
+
+
+class MemoryCache(HeaderCache):
+    '''
+    HeaderCache that lives in memory for the serve subcommand; entries are
+    kept pickled so a hit is a copy, like an entry read from disk
+    '''
+
+    def __init__(self, max_size=512 * 1024 * 1024):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        data = self.entries.pop(key, None)
+        if data is None:
+            return None
+        self.entries[key] = data  # Most recently used go last
+        return pickle.loads(data)
+
+    def put(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.entries[key] = data
+        self.size += len(data)
+        self.evict()
+
+    def evict(self):
+        removed = 0
+        while self.max_size < self.size and self.entries:
+            key, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+            removed += 1
+        return removed
+
+
+class RenderResult(object):
+    ''' Rendered hooks for one header, passed back from worker processes '''
+
+    def __init__(self, header_file, hooks="", hook_count=0, error=None, cache=None, selectors=()):
+        self.header_file = header_file
+        self.hooks = hooks
+        self.hook_count = hook_count
+        self.selectors = selectors  # (id, argument kinds, description) with --log-backend trace
+        self.error = error
+        self.cache = cache  # None when caching is off, else "hit" or "miss"
+        self.parse_time = 0.0
+        self.filter_time = 0.0
+        self.render_time = 0.0
+        self.unknowns_skipped = 0
+        self.already_hooked = 0
+        self.inherited_skipped = 0
+        self.class_name = None
+        self.interfaces = None  # Parsed models, only sent back for --export-db
+
+
+class ParsedHeader(object):
+    '''
+    Models of one header parsed ahead of rendering, for features that look
+    across headers; render_header() hooks them without parsing again
+    '''
+
+    def __init__(self, header_file, interfaces, model_key=None, parse_time=0.0, error=None):
+        self.header_file = header_file
+        self.interfaces = interfaces
+        self.model_key = model_key  # Cache key of the source, None if it isn't cached
+        self.parse_time = parse_time
+        self.error = error
+        self.inherited = None  # Declarations hooked in a superclass instead
+        self.digest = None  # sha1 of the source, compared by HeaderDiff
+
+
+class HeaderSection(object):
+    '''
+    One @interface ... @end of a file that holds a whole dump; only the
+    offsets are sent to worker processes, each reads its own slice.  The
+    name is a virtual path, e.g. "Dump.h/ClassName.h" or
+    "Dump.h/ClassName+Category.h", repeats get "-2", "-3", ...
+    '''
+
+    def __init__(self, file_path, start, end, class_name, category=None):
+        self.file_path = file_path
+        self.start = start
+        self.end = end
+        self.class_name = class_name
+        self.category = category
+        self.number = 1  # Set by split_header for sections of the same name
+
+    @property
+    def base_name(self):
+        if self.category:
+            return "%s+%s" % (self.class_name, self.category)
+        return self.class_name
+
+    @property
+    def name(self):
+        if 1 < self.number:
+            return os.path.join(self.file_path, "%s-%d.h" % (self.base_name, self.number))
+        return os.path.join(self.file_path, self.base_name + '.h')
+
+    def read(self):
+        with open(self.file_path, 'rb') as header_fp:
+            header_fp.seek(self.start)
+            source_code = header_fp.read(self.end - self.start)
+        if not isinstance(source_code, str):
+            source_code = source_code.decode('utf-8', 'replace')
+        return source_code
+
+
+class RunStats(object):
+    ''' Phase timings and per-header counters collected with --stats '''
+
+    PHASES = ['discovery', 'indexing', 'parsing', 'filtering', 'rendering', 'writing']
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.phases = dict((phase, 0.0) for phase in self.PHASES)
+        self.headers = []
+        self.hooks = 0
+        self.bytes = 0
+        self.errors = 0
+        self.unknowns_skipped = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def add(self, result, write_time):
+        self.phases['parsing'] += result.parse_time
+        self.phases['filtering'] += result.filter_time
+        self.phases['rendering'] += result.render_time
+        self.phases['writing'] += write_time
+        self.hooks += result.hook_count
+        self.bytes += len(result.hooks)
+        self.errors += 0 if result.error is None else 1
+        self.unknowns_skipped += result.unknowns_skipped
+        self.headers.append((
+            result.parse_time, result.header_file, result.hook_count, len(result.hooks),
+        ))
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+
+    def report(self):
+        ''' JSON serializable report '''
+        slowest = heapq.nlargest(self.slowest, self.headers)
+        return {
+            'elapsed': self.elapsed,
+            'phases': self.phases,
+            'headers': len(self.headers),
+            'errors': self.errors,
+            'hooks': self.hooks,
+            'bytes': self.bytes,
+            'unknowns_skipped': self.unknowns_skipped,
+            'slowest': [self.header_report(header) for header in slowest],
+            'per_header': [self.header_report(header) for header in self.headers],
+        }
+
+    def header_report(self, header):
+        parse_time, header_file, hook_count, length = header
+        return {'file': header_file, 'parse_time': parse_time,
+            'hooks': hook_count, 'bytes': length}
+
+    def summary(self):
+        ''' Print a human readable summary '''
+        print(INFO + "Run time %.3fs (parse, filter and render times are summed over workers)" % self.elapsed)
+        for phase in self.PHASES:
+            print("    %-10s %9.3fs" % (phase, self.phases[phase]))
+        print(INFO + "%d hook(s), %d byte(s), %d method(s) skipped for unknown types" % (
+            self.hooks, self.bytes, self.unknowns_skipped,
+        ))
+        print(INFO + "Slowest header(s) to parse:")
+        for parse_time, header_file, hook_count, length in heapq.nlargest(self.slowest, self.headers):
+            print("    %8.2fms  %5d hook(s)  %s" % (parse_time * 1000, hook_count, header_file))
+
+    def save(self, file_path):
+        with open(file_path, 'w') as stats_fp:
+            json.dump(self.report(), stats_fp, indent=2, sort_keys=True)
+
+
+class HookIndex(object):
+    '''
+    (class, selector) pairs already hooked in an existing tweak, read once
+    so --append only adds hooks that aren't there yet; getters and setters
+    are indexed by their hook names, e.g. "getName" and "setName:"
+    '''
+
+    def __init__(self):
+        self.hooks = set()
+        self.lines = set()  # Everything outside of %hook blocks, e.g. includes
+        self._digest = None
+
+    def __contains__(self, hook):
+        return hook in self.hooks
+
+    def __len__(self):
+        return len(self.hooks)
+
+    def read(self, file_path):
+        class_name = None
+        with open(file_path, 'r') as tweak_fp:
+            for line in tweak_fp:
+                if line.startswith('%hook'):
+                    class_name = line.split()[1] if 1 < len(line.split()) else None
+                elif line.startswith('%end'):
+                    class_name = None
+                elif class_name is None:
+                    self.lines.add(line.strip())
+                elif line.startswith(('+', '-')):
+                    selector = hook_selector(line)
+                    if selector is not None:
+                        self.hooks.add((class_name, selector))
+        self._digest = None
+
+    def has_text(self, text):
+        ''' True if the first line of text is already outside of the hooks '''
+        return text.strip().split('\n', 1)[0] in self.lines
+
+    def __str__(self):
+        if self._digest is None:
+            digest = hashlib.sha1()
+            for class_name, selector in sorted(self.hooks):
+                digest.update(("%s %s\n" % (class_name, selector)).encode('utf-8'))
+            self._digest = digest.hexdigest()
+        return self._digest
+
+
+class HookGroups(object):
+    '''
+    Wraps each hooked class in a Logos %group that the constructor of its
+    tweak file installs lazily (see GROUP_RUNTIME).  Units are what the
+    preferences plist turns on, one per class or per header directory
+    '''
+
+    def __init__(self, group_by, prefs_path=None, hooked=None):
+        self.group_by = group_by
+        self.prefs_path = prefs_path
+        self.hooked = hooked  # HookIndex with --append, group names must not clash
+        self.names = set()
+
+    def unit(self, result):
+        if self.group_by == 'directory':
+            return os.path.basename(os.path.dirname(result.header_file))
+        return result.class_name
+
+    def name(self, class_name):
+        ''' Unique group name, categories of a class each get their own '''
+        base = "IH_" + re.sub(r'\W', '_', class_name)
+        name = base
+        number = 1
+        while name in self.names or (self.hooked is not None and self.hooked.has_text("%group " + name)):
+            number += 1
+            name = "%s_%d" % (base, number)
+        self.names.add(name)
+        return name
+
+    def wrap(self, result):
+        ''' (hooks in a %group, (group name, class name, unit, hook count)) '''
+        name = self.name(result.class_name)
+        hooks = "%%group %s\n\n%s%%end\n\n\n" % (name, result.hooks)
+        return hooks, (name, result.class_name, self.unit(result), result.hook_count)
+
+    def installer(self, groups):
+        ''' Constructor that installs the groups written to one tweak file '''
+        if not groups:
+            return ""
+        groups = sorted(groups, key=lambda group: (group[1], group[0]))
+        tag = hashlib.sha1(' '.join(group[0] for group in groups).encode('utf-8')).hexdigest()[:8]
+        code = ["/* Hook groups, installed when their class is loaded */"]
+        code.append("static const char *const ih_group_classes_%s[] = {\n%s\n};" % (
+            tag, ',\n'.join('    %s' % c_string(group[1]) for group in groups),
+        ))
+        code.append("static const char *const ih_group_units_%s[] = {\n%s\n};" % (
+            tag, ',\n'.join('    %s' % c_string(group[2]) for group in groups),
+        ))
+        code.append("static unsigned char ih_group_done_%s[%d];\n" % (tag, len(groups)))
+        code.append("static void ih_group_init_%s(unsigned int group) {" % tag)
+        code.append("    switch (group) {")
+        for index, group in enumerate(groups):
+            code.append("    case %d: %%init(%s); break;" % (index, group[0]))
+        code.append("    }\n}\n")
+        code.append("static ih_groups_t ih_groups_%s = {\n    ih_group_classes_%s, ih_group_units_%s, "
+            "ih_group_done_%s, %d, ih_group_init_%s,\n};\n" % (tag, tag, tag, tag, len(groups), tag))
+        code.append("static void ih_groups_added_%s(const struct mach_header *header, intptr_t slide) {" % tag)
+        code.append("    ih_groups_image(&ih_groups_%s, header);\n}\n" % tag)
+        code.append("__attribute__((constructor)) static void ih_groups_load_%s(void) {" % tag)
+        if self.prefs_path is not None:
+            code.append("    ih_groups_prefs(&ih_groups_%s, %s);" % (tag, c_string(self.prefs_path)))
+        code.append("    _dyld_register_func_for_add_image(ih_groups_added_%s);\n}\n\n" % tag)
+        return '\n'.join(code)
+
+    def write_manifest(self, manifest_path, writers, append=False):
+        ''' JSON listing each unit, its groups and the file they are in '''
+        manifest = {'group_by': self.group_by, 'prefs': self.prefs_path, 'units': {}, 'groups': {}}
+        if append and os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as manifest_fp:
+                previous = json.load(manifest_fp)
+            manifest['units'].update(previous.get('units', {}))
+            manifest['groups'].update(previous.get('groups', {}))
+        for writer in writers:
+            for name, class_name, unit, hook_count in writer.groups:
+                manifest['groups'][name] = {
+                    'class': class_name, 'unit': unit, 'hooks': hook_count,
+                    'file': os.path.basename(writer.file_path),
+                }
+                manifest['units'].setdefault(unit, []).append(name)
+        for names in manifest['units'].values():
+            names.sort()
+        with TweakWriter(manifest_path) as manifest_fp:
+            manifest_fp.write(json.dumps(manifest, indent=2, sort_keys=True, separators=(',', ': ')) + "\n")
+        return len(manifest['groups']), len(manifest['units'])
+
+
+class TweakWriter(object):
+    '''
+    Buffered output for the tweak file; writes go to a temporary file that
+    is renamed over the target once the run completes, so an interrupted
+    run never leaves a truncated tweak behind
+    '''
+
+    def __init__(self, file_path, append=False, buffer_size=1024 * 1024):
+        self.file_path = os.path.abspath(file_path)
+        self.temp_path = "%s.%d.tmp" % (self.file_path, os.getpid())
+        self.output_fp = open(self.temp_path, 'wb', buffer_size)
+        self.bytes_written = 0
+        self.groups = []  # (name, class, unit, hook count) of the %groups written
+        if append and os.path.exists(self.file_path):
+            try:
+                with open(self.file_path, 'rb') as existing_fp:
+                    shutil.copyfileobj(existing_fp, self.output_fp, buffer_size)
+            except:
+                self.abort()
+                raise
+            self.bytes_written = self.output_fp.tell()
+
+    def write(self, text):
+        data = text if isinstance(text, bytes) else text.encode('utf-8')
+        self.output_fp.write(data)
+        self.bytes_written += len(data)
+
+    @property
+    def writers(self):
+        return [self]
+
+    def write_hooks(self, hooks, hook_count, group=None):
+        ''' Write the rendered hooks of one class '''
+        self.write(hooks)
+        if group is not None:
+            self.groups.append(group)
+
+    def write_all(self, text):
+        ''' Write text that every tweak file needs '''
+        self.write(text)
+
+    def commit(self):
+        ''' Flush and move the finished tweak into place '''
+        self.output_fp.close()
+        if hasattr(os, 'replace'):
+            os.replace(self.temp_path, self.file_path)
+        else:
+            if platform.system().lower() == 'windows' and os.path.exists(self.file_path):
+                os.remove(self.file_path)
+            os.rename(self.temp_path, self.file_path)
+
+    def abort(self):
+        ''' Discard everything written, the target file is left untouched '''
+        self.output_fp.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+
+class ShardedWriter(object):
+    '''
+    Spreads the %hook blocks over several .xm files so Theos can compile
+    them in parallel; each class goes to the shard with the fewest hooks.
+    Anything written with write() (includes, %ctor) only goes to the
+    first shard, which keeps the output file name.
+    '''
+
+    def __init__(self, file_path, shards, append=False):
+        self.file_paths = shard_paths(file_path, shards)
+        self.makefile_path = os.path.splitext(file_path)[0] + ".mk"
+        self.writers = []
+        try:
+            for shard_path in self.file_paths:
+                self.writers.append(TweakWriter(shard_path, append))
+        except:
+            self.abort()
+            raise
+        self.hook_counts = [0] * shards
+
+    @property
+    def bytes_written(self):
+        return sum(writer.bytes_written for writer in self.writers)
+
+    def write(self, text):
+        self.writers[0].write(text)
+
+    def write_all(self, text):
+        for writer in self.writers:
+            writer.write(text)
+
+    def write_hooks(self, hooks, hook_count, group=None):
+        if not hooks:
+            return
+        shard = self.hook_counts.index(min(self.hook_counts))
+        self.hook_counts[shard] += hook_count
+        self.writers[shard].write_hooks(hooks, hook_count, group)
+
+    def write_makefile(self):
+        ''' Makefile fragment listing the shards for $(TWEAK_NAME)_FILES '''
+        with TweakWriter(self.makefile_path) as makefile_fp:
+            makefile_fp.write("# Generated by ios-hooker, add to your Makefile with:\n")
+            makefile_fp.write("#   include %s\n" % os.path.basename(self.makefile_path))
+            makefile_fp.write("#   $(TWEAK_NAME)_FILES += $(IOS_HOOKER_FILES)\n")
+            makefile_fp.write("IOS_HOOKER_FILES = %s\n" % ' '.join(
+                os.path.basename(shard_path) for shard_path in self.file_paths
+            ))
+
+    def commit(self):
+        for writer in self.writers:
+            writer.commit()
+        self.write_makefile()
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+
+class HeaderServer(object):
+    '''
+    Parsed models of a header tree kept in memory by the serve subcommand;
+    each request hooks them with its own options.  A file is parsed again
+    when its mtime or size changes, and rendered classes stay in the
+    MemoryCache, so repeating options only costs the cache lookups
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.split_size = split_bytes(args)
+        self.files = {}  # Path -> ((mtime, size), TypeIndex, [ParsedHeader])
+        self.requests = 0
+
+    def load(self, file_paths):
+        ''' Parse the files that are new or changed, returns how many were parsed '''
+        stale = []
+        for file_path in file_paths:
+            try:
+                info = os.stat(file_path)
+            except OSError:
+                self.files.pop(file_path, None)
+                continue
+            stamp = (info.st_mtime, info.st_size)
+            entry = self.files.get(file_path)
+            if entry is None or entry[0] != stamp:
+                stale.append((file_path, stamp))
+        if not stale:
+            return 0
+        headers = []
+        indexes = []
+        for file_path, stamp in stale:
+            sections = list(split_header(file_path, self.split_size))
+            headers.extend(sections)
+            indexes.append((build_type_index(sections)[0], len(sections)))
+        items = parse_targets(self.args, len(headers), headers)
+        start = 0
+        for (file_path, stamp), (type_index, count) in zip(stale, indexes):
+            self.files[file_path] = (stamp, type_index, items[start:start + count])
+            start += count
+        return len(stale)
+
+    def generate(self, argv):
+        '''
+        Write the tweak for one request, argv holds the usual options
+        except --target; returns the output path or None if nothing matched
+        '''
+        parser = build_parser(
+            prog="%s serve" % os.path.basename(sys.argv[0]),
+            description='Generate hooks for the header files of the server',
+            targets=False,
+        )
+        args = prepare_args(parser.parse_args(argv))
+        args.target = self.args.target
+        args.jobs = 1  # The models are already in this process
+        args.memory_cache = self.args.memory_cache
+        if args.cache_dir is not None:
+            print(WARN + "Ignoring --cache, the server keeps rendered hooks in memory")
+            args.cache_dir = None
+        file_paths = list(target_files(args))
+        self.load(file_paths)
+        items = []
+        args.type_index = TypeIndex()
+        for file_path in file_paths:
+            entry = self.files.get(file_path)
+            if entry is not None:
+                args.type_index.update(entry[1])
+                items.extend(entry[2])
+        for parsed in items:
+            parsed.inherited = None  # Linked again with this request's options
+        generate(args, items)
+        return args.output if items else None
+
+    def handle(self, line):
+        '''
+        Run one JSON request, {"argv": [...], "cwd": "...", "tweak": true},
+        with the output of the run captured; returns the response
+        '''
+        self.requests += 1
+        started = time.time()
+        try:
+            request = json.loads(line.decode('utf-8'))
+            argv = [str(value) for value in request.get('argv', [])]
+            cwd = request.get('cwd')
+        except (ValueError, TypeError, AttributeError) as error:
+            return {'status': 2, 'log': WARN + "Invalid request; %s\n" % error, 'tweak': None}
+        status = 0
+        tweak = None
+        log = StringIO()
+        stdout, stderr = sys.stdout, sys.stderr
+        server_cwd = os.getcwd()
+        sys.stdout = sys.stderr = log
+        try:
+            if cwd is not None:
+                os.chdir(cwd)
+            output_path = self.generate(argv)
+            if output_path is not None and request.get('tweak', True):
+                with open(output_path, 'r') as tweak_fp:
+                    tweak = tweak_fp.read()
+        except SystemExit as error:
+            status = error.code if isinstance(error.code, int) else int(error.code is not None)
+        except Exception as error:
+            status = 1
+            print(WARN + "Request failed; %s" % error)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(server_cwd)
+        print(INFO + "Request %d: status %d in %.1fms" % (
+            self.requests, status, (time.time() - started) * 1000,
+        ))
+        return {'status': status, 'log': log.getvalue(), 'tweak': tweak}
+
+
+class ServeProtocol(asyncio.Protocol if asyncio is not None else object):
+    ''' One client connection, every line it sends is a request answered with a line of JSON '''
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            if line.strip():
+                response = self.server.handle(line)
+                self.transport.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+### Functions
+def display_info(msg):
+    ''' Clearline and print message '''
+    sys.stdout.write(chr(27) + '[2K')
+    sys.stdout.write('\r' + INFO + msg)
+    sys.stdout.flush()
+
+def strip_comments(line, in_comment=False):
+    ''' Remove comments from a line of source, tracks multi-line block comments '''
+    code = ''
+    while line:
+        if in_comment:
+            end = line.find('*/')
+            if end == -1:
+                return code, True
+            line = line[end + 2:]
+            in_comment = False
+        else:
+            block = line.find('/*')
+            inline = line.find('//')
+            if inline != -1 and (block == -1 or inline < block):
+                return code + line[:inline], False
+            if block == -1:
+                return code + line, False
+            code += line[:block] + ' '
+            line = line[block + 2:]
+            in_comment = True
+    return code, in_comment
+
+def is_complete(statement):
+    ''' Checks if a declaration is terminated or continues on the next line '''
+    if statement.startswith('@end'):
+        return True
+    elif statement.startswith(('@interface', '@protocol')):
+        return statement.count('(') == statement.count(')') and \
+            statement.count('<') == statement.count('>') and \
+            not statement.endswith((':', ','))
+    return statement.endswith(';')
+
+def split_parens(text):
+    ''' Split "(type) rest" into its parts, allows nested parentheses '''
+    depth = 0
+    for index, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return text[1:index].strip(), text[index + 1:].strip()
+    raise ValueError("Invalid syntax; no closing ')'")
+
+def parse_selector(text):
+    '''
+    Objective-c has the dumbest argument syntax of any programming language
+    I've ever encountered; split "name:(type)arg label:(type)arg" into the
+    method name and a list of ObjcArgument()
+    '''
+    method_name = None
+    arguments = []
+    match = SELECTOR_PART.match(text)
+    while match is not None:
+        label = match.group(1)
+        text = text[match.end():]
+        class_type = "id"
+        if text.startswith('('):
+            class_type, text = split_parens(text)
+        component = re.match(r'(\w+)\s*', text)
+        if component is None:
+            raise ValueError("Invalid syntax; missing argument name")
+        text = text[component.end():]
+        if method_name is None:
+            method_name, label = label, ""
+        arguments.append(ObjcArgument(class_type, component.group(1), external_name=label))
+        match = SELECTOR_PART.match(text)
+    return method_name, arguments
+
+def compile_regex(expression):
+    ''' Ensures we got a valid regex from user '''
+    try:
+        return re.compile(expression)
+    except:
+        print(WARN + "Invalid regular expression")
+        sys.exit(1)
+
+def throttle_log(statement, throttled):
+    ''' Only run a log statement when the hook's throttle allows it '''
+    if not throttled:
+        return statement
+    return "    if (ih_log) { %s }\n" % statement.strip()
+
+def method_description(class_name, method):
+    ''' "-[Class selector:]" as printed by %log '''
+    return "%s[%s %s]" % ("+" if method.is_static else "-", class_name, method.selector)
+
+def hook_selector(line):
+    ''' Selector hooked by a "-(type) name:(type) arg {" line, None if there isn't one '''
+    text = line.strip()[1:].rstrip('{').strip()
+    try:
+        if text.startswith('('):
+            text = split_parens(text)[1]
+        if ':' not in text:
+            match = re.match(r'\w+', text)
+            return match.group() if match is not None else None
+        method_name, arguments = parse_selector(text)
+    except ValueError:
+        return None
+    method = ObjcMethod(method_name)
+    method.arguments = arguments
+    return method.selector
+
+def shard_paths(file_path, shards):
+    ''' Tweak.xm, Tweak_1.xm, ... for --shards '''
+    stem, ext = os.path.splitext(file_path)
+    return [file_path] + ["%s_%d%s" % (stem, index, ext) for index in range(1, shards)]
+
+def trace_kind(objc_type):
+    ''' How a trace record stores a value of this type, None if it can't '''
+    name = re.sub(r'\bconst\s+', '', objc_type.class_name).strip()
+    if objc_type.is_pointer:
+        if name.endswith('*') or name.startswith('struct ') or name in TRACE_SCALARS or name == 'void':
+            return 'p'
+        return 'o'
+    if name.startswith('id<'):
+        return 'o'
+    return TRACE_SCALARS.get(name)
+
+def value_kind(printf, objc_type=None):
+    ''' trace_kind() of a logged value, from its NSLog format if the type is not given '''
+    if objc_type is None:
+        return PRINTF_KINDS[printf]
+    return trace_kind(objc_type)
+
+def trace_selector(description):
+    ''' Stable 64-bit id of a traced event, 0 is left for unwritten records '''
+    return int(hashlib.sha1(description.encode('utf-8')).hexdigest()[:16], 16) or 1
+
+def c_string(text):
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+def change_report_path(output_path):
+    return os.path.splitext(output_path)[0] + ".changes.json"
+
+def group_manifest_path(output_path):
+    return os.path.splitext(output_path)[0] + ".groups.json"
+
+def selector_table_path(output_path):
+    return os.path.splitext(output_path)[0] + ".selectors"
+
+def read_selector_table(table_path):
+    ''' Selector id -> (argument kinds, description) '''
+    table = {}
+    with open(table_path, 'r') as table_fp:
+        for line in table_fp:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            selector, kinds, description = line.split('\t', 2)
+            table[int(selector, 16)] = (kinds, description)
+    return table
+
+def write_selector_table(table_path, selectors, append=False):
+    ''' Sidecar file that maps the selector ids in a trace back to methods '''
+    table = {}
+    if append and os.path.exists(table_path):
+        table.update(read_selector_table(table_path))
+    table.update(selectors)
+    with TweakWriter(table_path) as table_fp:
+        table_fp.write("# ios-hooker selector table: id, argument kinds (%s), description\n" % (
+            "i=int u=unsigned f=float o=object p=pointer -=not recorded"
+        ))
+        for selector, (kinds, description) in sorted(table.items(), key=lambda item: item[1][1]):
+            table_fp.write("%016x\t%s\t%s\n" % (selector, kinds, description))
+    return len(table)
+
+def format_duration(nanoseconds):
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if scale <= nanoseconds:
+            return "%.1f%s" % (nanoseconds / scale, unit)
+    return "%.0fns" % nanoseconds
+
+def format_trace_value(kind, value):
+    ''' Raw 64-bit trace argument as its original type '''
+    if kind == 'i':
+        return str(value - (1 << 64) if value >> 63 else value)
+    if kind == 'u':
+        return str(value)
+    if kind == 'f':
+        return repr(struct.unpack('<d', struct.pack('<Q', value))[0])
+    if kind in ('o', 'p'):
+        return "0x%x" % value
+    return "?"
+
+def load_patterns(values):
+    ''' Expand "@file" values into the patterns listed in the file '''
+    patterns = []
+    for value in values:
+        if value.startswith('@'):
+            try:
+                with open(value[1:], 'r') as patterns_fp:
+                    for line in patterns_fp:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            patterns.append(line)
+            except IOError as error:
+                print(WARN + "Unable to read patterns from %s; %s" % (value[1:], error))
+                sys.exit(1)
+        else:
+            patterns.append(value)
+    return patterns
+
+def write_includes(output_fp):
+    ''' Add basic includes to the tweak '''
+    output_fp.write('#import <CoreFoundation/CoreFoundation.h>\n')
+    output_fp.write('#import <Foundation/Foundation.h>\n')
+    output_fp.write('#import <Security/Security.h>\n')
+    output_fp.write('#import <Security/SecCertificate.h>\n')
+    output_fp.write('\n')
+    output_fp.write('#import "substrate.h"\n')
+    output_fp.write('\n\n')
+
+def write_load_hook(output_fp):
+    ''' Log on Dylib load '''
+    output_fp.write("/* Dylib Constructor */\n")
+    output_fp.write("%"+"ctor {\n")
+    output_fp.write('    NSLog(@" --- iOS Hooker Loaded: %ss --- ", __FILE__);\n' % "%")
+    output_fp.write("}\n\n")
+
+def write_timing_start(output_fp, interval):
+    '''
+    Start dumping the --timing histograms from a constructor of its own,
+    so it is added even when --append finds a %ctor already
+    '''
+    output_fp.write("#ifndef IOS_HOOKER_TIMING_START\n#define IOS_HOOKER_TIMING_START\n")
+    output_fp.write("__attribute__((constructor)) static void ih_timing_init(void) {\n")
+    output_fp.write("    ih_timing_start(%d);\n" % interval)
+    output_fp.write("}\n#endif\n\n")
+
+def init_worker(args):
+    ''' Give each process the command line options '''
+    global _worker_args, _worker_cache
+    _worker_args = args
+    _worker_cache = args.memory_cache
+    if args.cache_dir is not None:
+        _worker_cache = HeaderCache(args.cache_dir)
+
+def render_options(args):
+    ''' Options that change the rendered hooks, part of every cache key '''
+    return (args.getters, args.setters, args.params, args.debug,
+        args.unknowns, args.check_arguments, args.method_filter, args.type_index.digest, args.log_backend,
+        args.throttle, args.hooked, args.timing)
+
+def parse_header(header_file):
+    ''' Parse a header ahead of rendering, returns a ParsedHeader '''
+    args = _worker_args
+    cache = _worker_cache
+    section = None
+    if isinstance(header_file, HeaderSection):
+        section, header_file = header_file, header_file.name
+    try:
+        objc = ObjcHeader(header_file, args.unknowns, args.verbose, section=section)
+        model_key = None
+        interfaces = None
+        if cache is not None:
+            model_key = cache.key(objc.source_code)
+            interfaces = cache.get(model_key)
+        started = time.time()
+        if interfaces is None:
+            interfaces = objc.interfaces
+            if cache is not None:
+                cache.put(model_key, interfaces)
+        parsed = ParsedHeader(header_file, interfaces, model_key, time.time() - started)
+        source_code = objc.source_code
+        if not isinstance(source_code, bytes):
+            source_code = source_code.encode('utf-8')
+        parsed.digest = hashlib.sha1(source_code).digest()
+        return parsed
+    except ValueError as error:
+        return ParsedHeader(header_file, None, error=str(error))
+
+def render_header(header_file):
+    '''
+    Parse a header and render its hooks to a string; returns a RenderResult
+    so the results can be written in order.  header_file can also be a
+    HeaderSection, or a ParsedHeader with models that are already parsed
+    '''
+    args = _worker_args
+    cache = _worker_cache
+    parsed = None
+    section = None
+    if isinstance(header_file, HeaderSection):
+        section, header_file = header_file, header_file.name
+    elif isinstance(header_file, ParsedHeader):
+        parsed = header_file
+        header_file = parsed.header_file
+        if parsed.error is not None:
+            return RenderResult(header_file, error=parsed.error)
+        if parsed.model_key is None:
+            cache = None  # Only headers read from disk are cached
+    output = StringIO()
+    try:
+        objc = ObjcHeader(header_file, args.unknowns, args.verbose,
+            None if parsed is None else parsed.interfaces, section)
+        objc.types = args.type_index
+        objc.check_arguments = args.check_arguments
+        objc.setters = args.setters
+        objc.getters = args.getters
+        objc.params = args.params
+        objc.debug = args.debug
+        objc.log = LOG_BACKENDS[args.log_backend]()
+        objc.throttle = args.throttle
+        objc.hooked = args.hooked
+        objc.inherited = None if parsed is None else parsed.inherited
+        objc.timing = args.timing
+        interfaces = None if parsed is None else parsed.interfaces
+        if cache is not None:
+            model_key = cache.key(objc.source_code) if parsed is None else parsed.model_key
+            render_key = cache.key(model_key, sorted(objc.inherited or ()), *render_options(args))
+            rendered = cache.get(render_key)
+            if rendered is not None:
+                hooks, hook_count, selectors, already_hooked, inherited_skipped, class_name = rendered
+                result = RenderResult(header_file, hooks, hook_count, cache="hit", selectors=selectors)
+                result.already_hooked = already_hooked
+                result.inherited_skipped = inherited_skipped
+                result.class_name = class_name
+                if parsed is not None:
+                    result.parse_time = parsed.parse_time
+                if args.export_db is not None:
+                    if interfaces is None:
+                        interfaces = cache.get(model_key)
+                    result.interfaces = objc.interfaces if interfaces is None else interfaces
+                return result
+            if interfaces is None:
+                interfaces = cache.get(model_key)
+                if interfaces is not None:
+                    objc._interfaces = interfaces
+        started = time.time()
+        objc.interfaces
+        parsed_at = time.time()
+        objc.known_methods()
+        filtered = time.time()
+        objc.save_hooks(output, args.method_filter)
+        result = RenderResult(header_file, output.getvalue(), objc._hook_count,
+            selectors=tuple(objc.timed) + tuple(objc.log.selectors))
+        result.parse_time = parsed_at - started if parsed is None else parsed.parse_time
+        result.filter_time = filtered - parsed_at + objc.filter_time
+        result.render_time = time.time() - filtered - objc.filter_time
+        result.unknowns_skipped = objc.unknowns_skipped
+        result.already_hooked = objc.already_hooked
+        result.inherited_skipped = objc.inherited_skipped
+        result.class_name = objc.class_name
+        if args.export_db is not None:
+            result.interfaces = objc.interfaces
+        if cache is not None:
+            if interfaces is None:
+                cache.put(model_key, objc.interfaces)
+            cache.put(render_key, (
+                result.hooks, result.hook_count, result.selectors, result.already_hooked,
+                result.inherited_skipped, result.class_name,
+            ))
+            result.cache = "miss"
+        return result
+    except ValueError as error:
+        return RenderResult(header_file, error=str(error))
+
+def build_type_index(ls, stats=None):
+    '''
+    Quick pre-pass over the targets to find every class and protocol,
+    returns the index and the number of header files seen
+    '''
+    type_index = TypeIndex()
+    total = 0
+    for header_file in ls:
+        total += 1
+        started = time.time()
+        try:
+            if isinstance(header_file, HeaderSection):
+                type_index.scan(header_file.read())
+                continue
+            with open(header_file, 'rb') as header_fp:
+                source_code = header_fp.read()
+            if not isinstance(source_code, str):
+                source_code = source_code.decode('utf-8', 'replace')
+            type_index.scan(source_code)
+        except (IOError, OSError):
+            continue
+        finally:
+            if stats is not None:
+                stats.phases['indexing'] += time.time() - started
+    return type_index, total
+
+def map_headers(function, ls, args, total):
+    ''' Yield function(header) for every header in order, with a process pool if --jobs > 1 '''
+    if 1 < args.jobs:
+        pool = multiprocessing.Pool(args.jobs, init_worker, (args,))
+        try:
+            for result in pool.imap(function, ls, max(1, total // (args.jobs * 8))):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        init_worker(args)
+        for header_file in ls:
+            yield function(header_file)
+
+def parse_targets(args, total, ls=None):
+    ''' Parse every target up front, returns a list of ParsedHeader '''
+    items = []
+    if ls is None:
+        ls = discover_targets(args)
+    for parsed in map_headers(parse_header, ls, args, total):
+        items.append(parsed)
+        display_info("Reading %d of %d files: %s... " % (
+            len(items), total, parsed.header_file[:-2],
+        ))
+    return items
+
+def link_hierarchy(items, args):
+    '''
+    Build the hierarchy of the classes that get hooked and mark the
+    declarations each one leaves to a superclass; serve keeps the
+    declarations of each class in its memory cache
+    '''
+    hierarchy = ClassHierarchy()
+    declarations = []
+    cache = args.memory_cache
+    for parsed in items:
+        if not parsed.interfaces:
+            declarations.append(None)
+            continue
+        declared = None
+        if cache is not None and parsed.model_key is not None:
+            declared_key = cache.key(parsed.model_key, 'declarations', args.type_index.digest,
+                args.unknowns, args.check_arguments, args.getters, args.setters, args.method_filter)
+            declared = cache.get(declared_key)
+        if declared is None:
+            objc = ObjcHeader(parsed.header_file, args.unknowns, False, parsed.interfaces)
+            objc.types = args.type_index
+            objc.check_arguments = args.check_arguments
+            objc.getters = args.getters
+            objc.setters = args.setters
+            declared = objc.declarations(args.method_filter)
+            if cache is not None and parsed.model_key is not None:
+                cache.put(declared_key, declared)
+        declarations.append(declared)
+        interface = parsed.interfaces[0]
+        hierarchy.add(interface.class_name, interface.superclass, declared)
+    for parsed, declared in zip(items, declarations):
+        if declared is not None:
+            parsed.inherited = hierarchy.inherited(parsed.interfaces[0].class_name, declared)
+    return hierarchy
+
+def parser_headers(ls, output_fp, args, total=None, stats=None, selectors=None, database=None,
+        groups=None):
+    '''
+    Parse an iterable of header files, with a process pool if --jobs > 1;
+    total is only used for the progress display, selectors collects the
+    trace selector table and database the parsed models
+    '''
+    if total is None:
+        total = len(ls)
+    errors = 0
+    parsed = 0
+    total_hooks = 0
+    already_hooked = 0
+    inherited_skipped = 0
+    cache_hits = 0
+    cache_misses = 0
+    results = map_headers(render_header, ls, args, total)
+    try:
+        for result in results:
+            parsed += 1
+            display_info("Parsing %d of %d files: %s... " % (
+                parsed, total, result.header_file[:-2],
+            ))
+            if args.verbose:
+                sys.stdout.write('\n')
+            if result.error is not None:
+                errors += 1
+                if args.verbose:
+                    print(WARN + "Error: Invalid objective-c header file; %s" % result.error)
+            if result.cache == "hit":
+                cache_hits += 1
+            elif result.cache == "miss":
+                cache_misses += 1
+            started = time.time()
+            if groups is not None and result.hooks:
+                hooks, group = groups.wrap(result)
+                output_fp.write_hooks(hooks, result.hook_count, group)
+            else:
+                output_fp.write_hooks(result.hooks, result.hook_count)
+            total_hooks += result.hook_count
+            already_hooked += result.already_hooked
+            inherited_skipped += result.inherited_skipped
+            if selectors is not None:
+                for selector, kinds, description in result.selectors:
+                    selectors[selector] = (kinds, description)
+            if database is not None and result.interfaces is not None:
+                database.add(result.header_file, result.interfaces)
+            if stats is not None:
+                stats.add(result, time.time() - started)
+    finally:
+        results.close()
+    display_info("Successfully parsed %d of %d file(s)\n" % (
+        parsed - errors, parsed,
+    ))
+    print(INFO + "Generated %d function hook(s)" % total_hooks)
+    if not args.keep_subclass_hooks:
+        print(INFO + "Removed %d hook(s) of methods hooked in a superclass" % inherited_skipped)
+    if args.hooked is not None:
+        print(INFO + "Appended %d new hook(s), skipped %d already in the tweak" % (
+            total_hooks, already_hooked,
+        ))
+    if args.cache_dir is not None:
+        evicted = HeaderCache(args.cache_dir, args.cache_size * 1024 * 1024).evict()
+        print(INFO + "Cache: %d hit(s), %d miss(es), %d evicted" % (
+            cache_hits, cache_misses, evicted,
+        ))
+
+def list_directory(directory):
+    ''' Yield (name, path, is_dir) for a directory, sorted for stable output '''
+    if scandir is not None:
+        entries = sorted(scandir(directory), key=lambda entry: entry.name)
+        for entry in entries:
+            yield entry.name, entry.path, entry.is_dir(follow_symlinks=False)
+    else:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            yield name, path, os.path.isdir(path) and not os.path.islink(path)
+
+def match_globs(patterns, name, relative_path):
+    ''' Check a file name or its path relative to the target against globs '''
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern):
+            return True
+    return False
+
+def scan_directory(class_dir, args, regex=None, root=None):
+    '''
+    Recursively scan a directory and yield the paths of header files as
+    they are found; excluded directories are never entered
+    '''
+    if root is None:
+        root = os.path.abspath(class_dir)
+        if args.file_regex is not None:
+            regex = compile_regex(args.file_regex)
+    try:
+        entries = list_directory(class_dir)
+        for name, path, is_dir in entries:
+            relative_path = os.path.relpath(path, root)
+            if match_globs(args.exclude, name, relative_path):
+                continue
+            if is_dir:
+                for header_file in scan_directory(path, args, regex, root):
+                    yield header_file
+                continue
+            if not name.endswith('.h'):
+                continue
+            if not args.next_step and name[:-2] in KNOWN_TYPES:
+                continue
+            if regex is not None and not regex.match(name):
+                continue
+            if args.include and not match_globs(args.include, name, relative_path):
+                continue
+            yield path
+    except OSError as error:
+        if args.verbose:
+            print(WARN + "Unable to scan %s; %s" % (class_dir, error))
+
+def split_header(file_path, mmap_size=None):
+    '''
+    Yield a file as is if it has one class, else a HeaderSection for each
+    @interface ... @end in it.  Files of at least mmap_size bytes are
+    memory-mapped and only the boundaries are matched; anything between two
+    classes (protocols, structs) stays with the class after it so the type
+    index still sees it
+    '''
+    try:
+        size = os.path.getsize(file_path)
+    except OSError:
+        size = 0
+    if size == 0:
+        yield file_path
+        return
+    with open(file_path, 'rb') as header_fp:
+        if mmap_size is not None and mmap_size <= size:
+            data = mmap.mmap(header_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = header_fp.read()
+    try:
+        sections = []
+        names = {}
+        start = 0
+        class_name = None
+        category = None
+        for match in SECTION_BOUNDARY.finditer(data):
+            if match.group(1) == b'interface':
+                if class_name is None and match.group(2):
+                    class_name = match.group(2).decode('utf-8')
+                    category = (match.group(3) or b'').decode('utf-8')
+            elif class_name is not None:
+                section = HeaderSection(file_path, start, match.end(), class_name, category)
+                section.number = names[section.base_name] = names.get(section.base_name, 0) + 1
+                sections.append(section)
+                start = match.end()
+                class_name = None
+                if 1 < len(sections):
+                    yield sections.pop(0)
+        if class_name is not None:
+            section = HeaderSection(file_path, start, size, class_name, category)  # Missing @end
+            section.number = names.get(section.base_name, 0) + 1
+            sections.append(section)
+        elif sections:
+            sections[-1].end = size  # Trailing protocols stay with the last class
+        if len(sections) < 2 and (not sections or sections[0].start == 0):
+            yield file_path  # A single class, parse it like any header
+            return
+        for section in sections:
+            yield section
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def target_files(args):
+    ''' Yield the path of every header file for the --target files and directories '''
+    for target in args.target:
+        if os.path.isdir(target):
+            for header_file in scan_directory(target, args):
+                yield header_file
+        elif os.path.exists(target):
+            yield target
+
+def split_bytes(args):
+    ''' --split-size in bytes '''
+    return None if args.split_size is None else int(args.split_size * 1024 * 1024)
+
+def discover_targets(args):
+    '''
+    Yield every header file for the --target files and directories, large
+    files are split into one HeaderSection per class
+    '''
+    split_size = split_bytes(args)
+    for header_file in target_files(args):
+        for header in split_header(header_file, split_size):
+            yield header
+
+
+def build_parser(prog=None, description='Generate hooks for an objc class header file', targets=True):
+    ''' Command line options shared by every way of generating a tweak '''
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=description,
+    )
+    parser.add_argument('--version',
         action='version',
         version='%(prog)s v0.1.1'
     )
@@ -502,12 +3476,13 @@ if __name__ == '__main__':
         action='store_true',
         dest='verbose',
     )
-    parser.add_argument('--target', '-t',
-        help='file or directory with objc header file(s)',
-        dest='target',
-        nargs='*',
-        required=True,
-    )
+    if targets:
+        parser.add_argument('--target', '-t',
+            help='file or directory with objc header file(s)',
+            dest='target',
+            nargs='*',
+            required=True,
+        )
     parser.add_argument('--output', '-o',
         help='output file with hooks (default: Tweak.xm)',
         default='Tweak.xm',
@@ -537,15 +3512,46 @@ if __name__ == '__main__':
         action='store_false',
         dest='unknowns',
     )
+    parser.add_argument('--check-arguments',
+        help='also skip functions with unknown argument types (default: false)',
+        action='store_true',
+        dest='check_arguments',
+    )
     parser.add_argument('--file-regex', '-f',
         help='only hook classes with file names that match a given regex (only valid with directory)',
         dest='file_regex',
         default=None,
     )
+    parser.add_argument('--include',
+        help='only hook header files that match a glob, may be repeated (only valid with directory)',
+        dest='include',
+        action='append',
+        default=[],
+    )
+    parser.add_argument('--exclude',
+        help='skip files and directories that match a glob, may be repeated (only valid with directory)',
+        dest='exclude',
+        action='append',
+        default=[],
+    )
+    parser.add_argument('--split-size',
+        help='memory-map files of at least N MB while they are split into one header per @interface, '
+            'smaller files are read (default: 1)',
+        dest='split_size',
+        type=float,
+        default=1.0,
+    )
     parser.add_argument('--method-regex', '-m',
-        help='only create hooks for methods that match a given regex',
+        help='only create hooks for methods that match a given regex, may be repeated or @file',
         dest='method_regex',
-        default=None,
+        action='append',
+        default=[],
+    )
+    parser.add_argument('--exclude-method', '-x',
+        help='skip methods that match a given regex, may be repeated or @file',
+        dest='exclude_method',
+        action='append',
+        default=[],
     )
     parser.add_argument('--getters', '-g',
         help='create hooks for @property getters (default: false)',
@@ -562,32 +3568,685 @@ if __name__ == '__main__':
         dest='params',
         action='store_true',
     )
+    parser.add_argument('--keep-subclass-hooks',
+        help='hook methods in every class that declares them, not just the highest superclass (default: false)',
+        dest='keep_subclass_hooks',
+        action='store_true',
+    )
     parser.add_argument('--debug',
         help='create debug logging messages for getters/setters (default: false)',
         dest='debug',
         action='store_true',
     )
-    args = parser.parse_args()
-    mode = 'a+' if args.append else 'w+'
-    output_fp = open(args.output, mode)
-    if args.includes:
-        if args.verbose:
-            print(INFO + "Adding basic #includes to tweak file")
-        write_includes(output_fp)
-    if args.load_hook:
+    parser.add_argument('--log-backend',
+        help='how generated hooks log: nslog, oslog, ring or trace (default: nslog)',
+        dest='log_backend',
+        choices=sorted(LOG_BACKENDS),
+        default='nslog',
+    )
+    parser.add_argument('--log-every',
+        help='only log 1 in N calls of each hooked method (default: every call)',
+        dest='log_every',
+        type=int,
+        default=0,
+    )
+    parser.add_argument('--log-rate',
+        help='log at most K calls per second of each hooked method (default: no limit)',
+        dest='log_rate',
+        type=int,
+        default=0,
+    )
+    parser.add_argument('--log-first',
+        help='only log the first M calls of each hooked method (default: no limit)',
+        dest='log_first',
+        type=int,
+        default=0,
+    )
+    parser.add_argument('--throttle',
+        help='override throttling for methods matching a regex, e.g. "^layout=every:100,rate:5" (may be repeated)',
+        dest='throttle_overrides',
+        action='append',
+        default=[],
+    )
+    parser.add_argument('--timing',
+        help='measure how long each hooked method takes in log-scale histograms on the device '
+            '(default: false)',
+        dest='timing',
+        action='store_true',
+    )
+    parser.add_argument('--timing-interval',
+        help='seconds between dumps of the --timing histograms (default: 10)',
+        dest='timing_interval',
+        type=int,
+        default=10,
+    )
+    parser.add_argument('--cache',
+        help='directory used to cache parsed headers between runs (default: off)',
+        dest='cache_dir',
+        default=None,
+    )
+    parser.add_argument('--cache-size',
+        help='maximum size of the cache directory in MB (default: 512)',
+        dest='cache_size',
+        type=int,
+        default=512,
+    )
+    parser.add_argument('--shards',
+        help='split hooks over N .xm files and write a Makefile fragment (default: 1)',
+        dest='shards',
+        type=int,
+        default=1,
+    )
+    parser.add_argument('--groups',
+        help='wrap each class in a %%group that is installed when the class is loaded, '
+            'preferences toggle a class or a header directory (default: off)',
+        dest='group_by',
+        choices=['class', 'directory'],
+        default=None,
+    )
+    parser.add_argument('--group-prefs',
+        help='only install groups turned on in this preferences plist on the device, '
+            'implies --groups class if not given',
+        dest='group_prefs',
+        default=None,
+    )
+    parser.add_argument('--export-db',
+        help='write every parsed class and method to an SQLite database for the query subcommand',
+        dest='export_db',
+        default=None,
+    )
+    parser.add_argument('--stats',
+        help='write a JSON profiling report to a file and print a summary',
+        dest='stats_file',
+        default=None,
+    )
+    parser.add_argument('--slowest',
+        help='number of slowest headers shown with --stats (default: 10)',
+        dest='slowest',
+        type=int,
+        default=10,
+    )
+    parser.add_argument('--jobs', '-j',
+        help='number of processes used to parse headers, 0 for one per cpu (default: 1)',
+        dest='jobs',
+        type=int,
+        default=1,
+    )
+    return parser
+
+def prepare_args(args):
+    ''' Validate and compile the options that every header needs '''
+    if args.jobs < 1:
+        args.jobs = multiprocessing.cpu_count()
+    for option, value in [('--log-every', args.log_every), ('--log-rate', args.log_rate),
+                          ('--log-first', args.log_first)]:
+        if value < 0:
+            print(WARN + "Invalid %s; must be 0 or more" % option)
+            sys.exit(1)
+    try:
+        overrides = []
+        for override in args.throttle_overrides:
+            pattern, _, spec = override.rpartition('=')
+            overrides.append((pattern, Throttle.from_string(spec)))
+        args.throttle = ThrottleRules(
+            Throttle(args.log_every, args.log_rate, args.log_first), overrides,
+        )
+    except ValueError as error:
+        print(WARN + "Invalid --throttle; %s" % error)
+        sys.exit(1)
+    if not args.throttle.is_active:
+        args.throttle = None
+    if args.timing_interval < 1:
+        print(WARN + "Invalid --timing-interval; must be at least 1 second")
+        sys.exit(1)
+    args.method_filter = None
+    if 0 < len(args.method_regex) + len(args.exclude_method):
+        args.method_filter = MethodFilter(
+            load_patterns(args.method_regex),
+            load_patterns(args.exclude_method),
+        )
+    if args.group_prefs is not None and args.group_by is None:
+        args.group_by = 'class'
+    args.memory_cache = None  # Set by serve, used instead of --cache
+    return args
+
+def appended(args, text):
+    ''' True if --append found text in the existing tweak already '''
+    return args.hooked is not None and args.hooked.has_text(text)
+
+def generate(args, items=None):
+    '''
+    Scan the targets and write the tweak, or hook items of already parsed
+    (file path, interfaces) when args.type_index is set by the caller
+    '''
+    stats = RunStats(args.slowest) if args.stats_file is not None else None
+    args.hooked = None
+    if args.append:
+        args.hooked = HookIndex()
+        for tweak_path in shard_paths(args.output, args.shards):
+            if os.path.exists(tweak_path):
+                args.hooked.read(tweak_path)
         if args.verbose:
-            print(INFO + "Adding load hook to tweak file")
-        write_load_hook(output_fp)
-    if 1 == len(args.target) and os.path.isdir(args.target[0]):
-        args.target = scan_directory(args.target[0], args)
+            print(INFO + "Found %d hook(s) in the existing tweak" % len(args.hooked))
+    if items is None:
+        args.type_index, total = build_type_index(discover_targets(args), stats)
     else:
-        args.target = filter(lambda file_name: os.path.exists(file_name), args.target)
-    if 0 < len(args.target):
-        parser_headers(args.target, output_fp, args)
-        output_fp.seek(0)
-        length = len(output_fp.read())
-        output_fp.close()
-        print(INFO + "Hooks written to: "),
-        print(args.output + " (%d bytes)" % length)
+        total = len(items)
+    if stats is not None:
+        stats.phases['discovery'] = time.time() - stats.started - stats.phases['indexing']
+    if 0 < total:
+        print(INFO + "Found %s target file(s)" % total)
+        if args.verbose:
+            print(INFO + "Indexed %d class(es) and protocol(s)" % len(args.type_index))
+        if not args.keep_subclass_hooks:
+            if items is None:
+                items = parse_targets(args, total)
+            link_hierarchy(items, args)
+        if 1 < args.shards:
+            output = ShardedWriter(args.output, args.shards, args.append)
+        else:
+            output = TweakWriter(args.output, args.append)
+        database = None
+        if args.export_db is not None:
+            database = MethodDatabase(args.export_db, create=True)
+        try:
+            with output as output_fp:
+                if args.includes and not appended(args, '#import "substrate.h"'):
+                    if args.verbose:
+                        print(INFO + "Adding basic #includes to tweak file")
+                    write_includes(output_fp)
+                if args.timing and not appended(args, TIMING_RUNTIME):
+                    output_fp.write_all(TIMING_RUNTIME)
+                if args.timing and not appended(args, '#ifndef IOS_HOOKER_TIMING_START'):
+                    write_timing_start(output_fp, args.timing_interval)
+                if args.load_hook and not appended(args, '%ctor {'):
+                    if args.verbose:
+                        print(INFO + "Adding load hook to tweak file")
+                    write_load_hook(output_fp)
+                prelude = LOG_BACKENDS[args.log_backend]().prelude()
+                if not appended(args, prelude):
+                    output_fp.write_all(prelude)
+                if args.throttle is not None and not appended(args, THROTTLE_RUNTIME):
+                    output_fp.write_all(THROTTLE_RUNTIME)
+                groups = None
+                if args.group_by is not None:
+                    groups = HookGroups(args.group_by, args.group_prefs, args.hooked)
+                    if not appended(args, GROUP_RUNTIME):
+                        output_fp.write_all(GROUP_RUNTIME)
+                selectors = {} if args.log_backend == 'trace' or args.timing else None
+                parser_headers(discover_targets(args) if items is None else items,
+                    output_fp, args, total, stats, selectors, database, groups)
+                if groups is not None:
+                    for writer in output_fp.writers:
+                        writer.write(groups.installer(writer.groups))
+        except BaseException:
+            if database is not None:
+                database.abort()
+            raise
+        if database is not None:
+            database.add_types(args.type_index)
+            database.commit()
+            print(INFO + "Method index written to: %s (%d class(es), %d method(s))" % (
+                args.export_db, database.classes, database.methods,
+            ))
+        if 1 < args.shards:
+            for shard_path, hook_count in zip(output_fp.file_paths, output_fp.hook_counts):
+                print(INFO + "Shard %s: %d hook(s)" % (shard_path, hook_count))
+            print(INFO + "Makefile fragment written to: %s" % output_fp.makefile_path)
+        destination = args.output if args.shards < 2 else "%d shards" % args.shards
+        print(INFO + "Hooks written to: %s (%d bytes)" % (
+            destination, output_fp.bytes_written,
+        ))
+        if groups is not None:
+            manifest_path = group_manifest_path(args.output)
+            group_count, unit_count = groups.write_manifest(manifest_path, output_fp.writers, args.append)
+            print(INFO + "Group manifest written to: %s (%d group(s), %d unit(s))" % (
+                manifest_path, group_count, unit_count,
+            ))
+        if selectors is not None:
+            table_path = selector_table_path(args.output)
+            count = write_selector_table(table_path, selectors, args.append)
+            print(INFO + "Selector table written to: %s (%d selector(s))" % (table_path, count))
+        if stats is not None:
+            stats.finish()
+            stats.summary()
+            stats.save(args.stats_file)
+            print(INFO + "Profiling report written to: %s" % args.stats_file)
     else:
         print(WARN + "No valid targets found")
+
+def profile_main(argv):
+    ''' Regenerate a tweak using call counts from captured hook logs '''
+    parser = build_parser(
+        prog="%s profile" % os.path.basename(sys.argv[0]),
+        description='Regenerate hooks using call counts from captured hook logs',
+    )
+    parser.add_argument('--log', '-L',
+        help='syslog capture with the output of a previous tweak (may be repeated)',
+        dest='logs',
+        action='append',
+        required=True,
+    )
+    parser.add_argument('--hot-calls',
+        help='methods called at least this many times are hot (default: 10000)',
+        dest='hot_calls',
+        type=int,
+        default=10000,
+    )
+    parser.add_argument('--hot-action',
+        help='what to do with hot methods: throttle or exclude (default: throttle)',
+        dest='hot_action',
+        choices=['throttle', 'exclude'],
+        default='throttle',
+    )
+    parser.add_argument('--hot-throttle',
+        help='throttle used for hot methods (default: rate:1)',
+        dest='hot_throttle',
+        default='rate:1',
+    )
+    parser.add_argument('--min-calls',
+        help='drop methods called fewer times than this, 0 keeps them (default: 1)',
+        dest='min_calls',
+        type=int,
+        default=1,
+    )
+    args = prepare_args(parser.parse_args(argv))
+    try:
+        hot_throttle = Throttle.from_string(args.hot_throttle)
+    except ValueError as error:
+        print(WARN + "Invalid --hot-throttle; %s" % error)
+        os._exit(1)
+    profile = CallProfile(args.hot_calls, args.min_calls, args.hot_action, hot_throttle)
+    for log_path in args.logs:
+        display_info("Reading %s... " % log_path)
+        profile.read(log_path)
+    profile.finish()
+    display_info("Counted %d call(s) to %d method(s)\n" % (
+        profile.matches, len(profile.counts),
+    ))
+    for (class_name, method_name), count in profile.hottest():
+        print("    %10d  %s %s" % (count, class_name or "*", method_name))
+    if args.method_filter is None:
+        args.method_filter = MethodFilter()
+    args.method_filter.profile = profile
+    if args.hot_action == 'throttle':
+        if args.throttle is None:
+            args.throttle = ThrottleRules(Throttle())
+        args.throttle.profile = profile
+    generate(args)
+
+def trace_main(argv):
+    ''' Summarize or dump binary traces written by the trace log backend '''
+    parser = argparse.ArgumentParser(
+        prog="%s trace" % os.path.basename(sys.argv[0]),
+        description='Decode binary traces written with --log-backend trace',
+    )
+    parser.add_argument('traces',
+        help='trace file(s) copied from the device',
+        nargs='+',
+    )
+    parser.add_argument('--table',
+        help='selector table written next to the tweak (default: Tweak.selectors)',
+        dest='table',
+        default='Tweak.selectors',
+    )
+    parser.add_argument('--dump',
+        help='print every record instead of a summary (default: false)',
+        dest='dump',
+        action='store_true',
+    )
+    parser.add_argument('--top',
+        help='number of selectors shown in the summary (default: 20)',
+        dest='top',
+        type=int,
+        default=20,
+    )
+    parser.add_argument('--json',
+        help='write the summary as JSON to a file',
+        dest='json_file',
+        default=None,
+    )
+    parser.add_argument('--batch-size',
+        help='records decoded at a time (default: 1048576)',
+        dest='batch_size',
+        type=int,
+        default=1024 * 1024,
+    )
+    args = parser.parse_args(argv)
+    try:
+        table = read_selector_table(args.table)
+    except (IOError, ValueError) as error:
+        print(WARN + "Unable to read selector table %s; %s" % (args.table, error))
+        os._exit(1)
+    stats = TraceStats()
+    for trace_path in args.traces:
+        try:
+            reader = TraceReader(trace_path)
+        except (IOError, ValueError) as error:
+            print(WARN + "Unable to read trace; %s" % error)
+            continue
+        with reader:
+            if args.dump:
+                for timestamp, thread, selector, values in reader.records():
+                    if not selector:
+                        continue
+                    kinds, description = table.get(selector, ('', "<%016x>" % selector))
+                    print("%.9f [%d] %s %s" % (
+                        reader.seconds(timestamp), thread, description, ' '.join(
+                            format_trace_value(kind, value) for kind, value in zip(kinds, values)
+                        ),
+                    ))
+                continue
+            display_info("Reading %s (%d record(s))... " % (trace_path, reader.count))
+            stats.nanoseconds_per_tick = reader.nanoseconds_per_tick
+            stats.dropped += reader.dropped
+            for batch in reader.batches(args.batch_size):
+                stats.add(batch)
+                del batch
+    if args.dump:
+        return
+    report = stats.report(table, args.top)
+    display_info("Decoded %d event(s) from %d thread(s) over %.3fs\n" % (
+        report['events'], report['threads'], report['duration'],
+    ))
+    if report['dropped'] or report['unfinished']:
+        print(WARN + "%d event(s) dropped by a full trace, %d unfinished" % (
+            report['dropped'], report['unfinished'],
+        ))
+    for entry in report['busiest']:
+        print("    %10d  %10.1f/s  %s" % (entry['events'], entry['per_second'], entry['description']))
+    if args.json_file is not None:
+        with open(args.json_file, 'w') as json_fp:
+            json.dump(report, json_fp, indent=2, sort_keys=True)
+        print(INFO + "Summary written to: %s" % args.json_file)
+
+def timing_main(argv):
+    ''' Merge the histogram dumps written by --timing into a latency report '''
+    parser = argparse.ArgumentParser(
+        prog="%s timing" % os.path.basename(sys.argv[0]),
+        description='Merge histogram dumps written with --timing into p50/p99 latencies',
+    )
+    parser.add_argument('dumps',
+        help='timing dump(s) copied from the device, e.g. ios-hooker-1234.timing',
+        nargs='+',
+    )
+    parser.add_argument('--table',
+        help='selector table written next to the tweak (default: Tweak.selectors)',
+        dest='table',
+        default='Tweak.selectors',
+    )
+    parser.add_argument('--top',
+        help='number of hooks to show (default: 20)',
+        dest='top',
+        type=int,
+        default=20,
+    )
+    parser.add_argument('--sort',
+        help='order hooks by p99, p50, mean, total time or calls (default: p99)',
+        dest='sort',
+        choices=['p99', 'p50', 'mean', 'total', 'calls'],
+        default='p99',
+    )
+    parser.add_argument('--json',
+        help='write the report as JSON to a file',
+        dest='json_file',
+        default=None,
+    )
+    args = parser.parse_args(argv)
+    try:
+        table = read_selector_table(args.table)
+    except (IOError, ValueError) as error:
+        print(WARN + "Unable to read selector table %s; %s" % (args.table, error))
+        os._exit(1)
+    histograms = TimingHistograms()
+    for dump_path in args.dumps:
+        try:
+            histograms.read(dump_path)
+        except (IOError, ValueError) as error:
+            print(WARN + "Unable to read timing dump %s; %s" % (dump_path, error))
+    report = histograms.report(table, args.top, args.sort)
+    print(INFO + "Merged %d dump(s), %d timed hook(s)" % (report['dumps'], report['selectors']))
+    print("    %10s  %9s  %9s  %9s  %9s  %s" % ('calls', 'mean', 'p50', 'p99', 'total', 'method'))
+    for entry in report['slowest']:
+        print("    %10d  %9s  %9s  %9s  %9s  %s" % (
+            entry['calls'], format_duration(entry['mean']), format_duration(entry['p50']),
+            format_duration(entry['p99']), format_duration(entry['total']), entry['description'],
+        ))
+    if args.json_file is not None:
+        with open(args.json_file, 'w') as json_fp:
+            json.dump(report, json_fp, indent=2, sort_keys=True)
+        print(INFO + "Report written to: %s" % args.json_file)
+
+def query_main(argv):
+    ''' Search a database written with --export-db, and optionally hook the matches '''
+    parser = build_parser(
+        prog="%s query" % os.path.basename(sys.argv[0]),
+        description='Search the methods in a database written with --export-db',
+        targets=False,
+    )
+    parser.add_argument('--db', '-D',
+        help='database written with --export-db',
+        dest='db',
+        required=True,
+    )
+    parser.add_argument('--returns',
+        help='only methods returning this type, e.g. "BOOL"',
+        dest='returns',
+        default=None,
+    )
+    parser.add_argument('--takes',
+        help='only methods with an argument of this type, e.g. "NSData*" (may be repeated)',
+        dest='takes',
+        action='append',
+        default=[],
+    )
+    parser.add_argument('--selector',
+        help='only selectors matching a glob, e.g. "set*:"',
+        dest='selector',
+        default=None,
+    )
+    parser.add_argument('--class',
+        help='only classes matching a glob',
+        dest='class_glob',
+        default=None,
+    )
+    parser.add_argument('--subclass-of',
+        help='only a class and its subclasses',
+        dest='subclass_of',
+        default=None,
+    )
+    parser.add_argument('--kind',
+        help='only class methods, instance methods or properties',
+        dest='kind',
+        choices=MethodDatabase.KINDS,
+        default=None,
+    )
+    parser.add_argument('--source',
+        help='only classes from header files matching a glob',
+        dest='source',
+        default=None,
+    )
+    parser.add_argument('--limit',
+        help='number of matches printed, 0 for all (default: 50)',
+        dest='limit',
+        type=int,
+        default=50,
+    )
+    parser.add_argument('--generate',
+        help='write hooks for the matches to --output (default: false)',
+        dest='generate',
+        action='store_true',
+    )
+    args = prepare_args(parser.parse_args(argv))
+    try:
+        database = MethodDatabase(args.db)
+        started = time.time()
+        rows = database.search(args.returns, args.takes, args.selector, args.class_glob,
+            args.kind, args.subclass_of, args.source)
+        elapsed = time.time() - started
+    except (IOError, sqlite3.Error) as error:
+        print(WARN + "Unable to query %s; %s" % (args.db, error))
+        os._exit(1)
+    for row in rows[:args.limit] if 0 < args.limit else rows:
+        class_name, path, kind, name, selector, return_type = row[2], row[6], row[7], row[8], row[9], row[10]
+        if kind == 'property':
+            description = "@property (%s) %s.%s" % (return_type, class_name, name)
+        else:
+            description = "%s(%s)[%s %s]" % ("+" if kind == 'class' else "-", return_type, class_name, selector)
+        print("    %-70s %s" % (description, os.path.basename(path)))
+    print(INFO + "%d match(es) in %.1fms" % (len(rows), elapsed * 1000))
+    if args.generate and rows:
+        args.type_index = database.types()
+        generate(args, database.interfaces(rows))
+
+def diff_main(argv):
+    ''' Hook only the methods that were added or changed since an older dump '''
+    parser = build_parser(
+        prog="%s diff" % os.path.basename(sys.argv[0]),
+        description='Generate hooks for the methods added or changed between two header dumps',
+    )
+    parser.add_argument('--old', '-O',
+        help='file or directory with the header file(s) of the previous version',
+        dest='old_target',
+        nargs='+',
+        required=True,
+    )
+    parser.add_argument('--report',
+        help='JSON change report (default: next to --output, e.g. Tweak.changes.json)',
+        dest='report',
+        default=None,
+    )
+    args = prepare_args(parser.parse_args(argv))
+    started = time.time()
+    old_args = argparse.Namespace(**vars(args))
+    old_args.target = args.old_target
+    old_files = list(discover_targets(old_args))
+    old_items = parse_targets(old_args, len(old_files), old_files)
+    args.type_index, total = build_type_index(discover_targets(args))
+    new_items = parse_targets(args, total)
+    changes = HeaderDiff()
+    changes.compare(old_items, new_items)
+    display_info("Compared %d old and %d new file(s) in %.1fs\n" % (
+        len(old_items), len(new_items), time.time() - started,
+    ))
+    added, changed, removed = changes.counts()
+    print(INFO + "Classes: %d added, %d removed, %d changed" % (
+        len(changes.added_classes), len(changes.removed_classes), len(changes.changed_classes),
+    ))
+    print(INFO + "Methods: %d added, %d changed, %d removed" % (added, changed, removed))
+    report_path = args.report if args.report is not None else change_report_path(args.output)
+    with TweakWriter(report_path) as report_fp:
+        report_fp.write(json.dumps(changes.report(), indent=2, sort_keys=True, separators=(',', ': ')) + "\n")
+    print(INFO + "Change report written to: %s" % report_path)
+    items = changes.hooked_items(new_items)
+    if items:
+        generate(args, items)
+    else:
+        print(INFO + "Nothing to hook, no methods were added or changed")
+
+def serve_main(argv):
+    ''' Keep the parsed headers in memory and generate tweaks for requests on a UNIX socket '''
+    parser = build_parser(
+        prog="%s serve" % os.path.basename(sys.argv[0]),
+        description='Parse header files once and generate tweaks for requests sent over a UNIX socket',
+    )
+    parser.add_argument('--socket', '-S',
+        help='UNIX socket to listen on (default: ios-hooker.sock)',
+        dest='socket_path',
+        default='ios-hooker.sock',
+    )
+    args = prepare_args(parser.parse_args(argv))
+    if asyncio is None or not hasattr(socket, 'AF_UNIX'):
+        print(WARN + "serve needs Python 3 and UNIX sockets")
+        os._exit(1)
+    socket_path = os.path.abspath(args.socket_path)
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            print(WARN + "%s exists and is not a socket" % socket_path)
+            os._exit(1)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print(WARN + "A server is already listening on %s" % socket_path)
+            os._exit(1)
+        except socket.error:
+            os.remove(socket_path)  # Left behind by a server that was killed
+        finally:
+            probe.close()
+    args.target = [os.path.abspath(target) for target in args.target]
+    args.memory_cache = MemoryCache(args.cache_size * 1024 * 1024)
+    server = HeaderServer(args)
+    started = time.time()
+    count = server.load(list(target_files(args)))
+    args.jobs = 1  # Edited files are few, a process pool costs more than it saves
+    display_info("Parsed %d file(s) in %.1fs\n" % (count, time.time() - started))
+    loop = asyncio.new_event_loop()
+    try:
+        listener = loop.run_until_complete(
+            loop.create_unix_server(lambda: ServeProtocol(server), socket_path)
+        )
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        print(INFO + "Listening on %s, stop with Ctrl+C" % socket_path)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+    finally:
+        loop.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def request_main(argv):
+    ''' Send generation options to a running serve subcommand '''
+    parser = argparse.ArgumentParser(
+        prog="%s request" % os.path.basename(sys.argv[0]),
+        description='Generate a tweak with a running serve subcommand; '
+            'any other options are passed on, e.g. -o Tweak.xm -m "^init"',
+    )
+    parser.add_argument('--socket', '-S',
+        help='UNIX socket of the server (default: ios-hooker.sock)',
+        dest='socket_path',
+        default='ios-hooker.sock',
+    )
+    args, options = parser.parse_known_args(argv)
+    request = {'argv': options, 'cwd': os.getcwd(), 'tweak': False}
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(args.socket_path)
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = client.recv(64 * 1024)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            client.close()
+        response = json.loads(data.decode('utf-8'))
+    except (socket.error, ValueError) as error:
+        print(WARN + "No response from %s; %s" % (args.socket_path, error))
+        os._exit(1)
+    sys.stdout.write(response['log'])
+    sys.exit(response['status'])
+
+SUBCOMMANDS = {
+    'diff': diff_main,
+    'profile': profile_main,
+    'query': query_main,
+    'request': request_main,
+    'serve': serve_main,
+    'timing': timing_main,
+    'trace': trace_main,
+}
+
+
+### Main
+if __name__ == '__main__':
+    if 1 < len(sys.argv) and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        args = prepare_args(build_parser().parse_args())
+        generate(args)